@@ -3,11 +3,15 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import functools
+import shutil
+import tempfile
 
 from gevent import pywsgi
 
 from confusionflow import _version
 from confusionflow.server import create_app
+from confusionflow.server.prefork import GRACEFUL_TIMEOUT, PreforkServer
 
 __version__ = _version.__version__
 
@@ -15,14 +19,55 @@ __version__ = _version.__version__
 def main():
     parser = argparse.ArgumentParser(description="ConfusionFlow CLI")
     parser.add_argument("--host", type=str, default="localhost")
-    parser.add_argument("--logdir", type=str, required=True)
+    parser.add_argument(
+        "--logdir",
+        type=str,
+        action="append",
+        default=[],
+        help="path to a logdir or `<name>=<path>` to serve it under /api/<name>, "
+        "can be given several times",
+    )
+    parser.add_argument(
+        "--rootdir", type=str, help="folder whose subfolders are served as logdirs"
+    )
     parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of server processes accepting connections",
+    )
+    parser.add_argument(
+        "--cpu-workers",
+        type=int,
+        default=0,
+        help="number of processes per server process serializing foldlog data",
+    )
+    parser.add_argument(
+        "--cachedir",
+        type=str,
+        help="folder of the response cache shared by the server processes, "
+        "a temporary folder is used with several workers by default",
+    )
+    parser.add_argument(
+        "--graceful-timeout",
+        type=float,
+        default=GRACEFUL_TIMEOUT,
+        help="seconds a stopping worker has to finish its open requests",
+    )
 
     FLAGS = parser.parse_args()
+    if not FLAGS.logdir and FLAGS.rootdir is None:
+        parser.error("either --logdir or --rootdir is required")
+    if FLAGS.workers < 1:
+        parser.error("--workers must be at least 1")
 
-    confusionflow_app = create_app(FLAGS.logdir)
+    logdir, logdirs = parse_logdirs(parser, FLAGS.logdir)
 
-    http_server = pywsgi.WSGIServer((FLAGS.host, FLAGS.port), confusionflow_app)
+    cachedir = FLAGS.cachedir
+    if cachedir is None and FLAGS.workers > 1:
+        cachedir = tempfile.mkdtemp(prefix="confusionflow-cache-")
+    config = {"CACHE_DIR": cachedir, "CPU_WORKERS": FLAGS.cpu_workers}
 
     try:
         print(
@@ -30,9 +75,43 @@ def main():
                 FLAGS.host, FLAGS.port
             )
         )
-        http_server.serve_forever()
+        if FLAGS.workers > 1:
+            app_factory = functools.partial(
+                create_app, logdir, logdirs, FLAGS.rootdir, config
+            )
+            server = PreforkServer(
+                (FLAGS.host, FLAGS.port),
+                app_factory,
+                FLAGS.workers,
+                FLAGS.graceful_timeout,
+            )
+            server.serve_forever()
+        else:
+            confusionflow_app = create_app(logdir, logdirs, FLAGS.rootdir, config)
+            http_server = pywsgi.WSGIServer((FLAGS.host, FLAGS.port), confusionflow_app)
+            http_server.serve_forever()
     except KeyboardInterrupt:
         print("Server received KeyboardInterrupt. Shutting down ...")
+    finally:
+        if FLAGS.cachedir is None and cachedir is not None:
+            shutil.rmtree(cachedir, ignore_errors=True)
+
+
+def parse_logdirs(parser, values):
+    """Splits the `--logdir` values into the unnamed default logdir and a dict
+    of named logdirs."""
+    logdir = None
+    logdirs = dict()
+    for value in values:
+        name, separator, path = value.partition("=")
+        if separator:
+            logdirs[name] = path
+        elif logdir is None:
+            logdir = value
+        else:
+            parser.error("only one --logdir can be given without a name")
+
+    return logdir, logdirs
 
 
 if __name__ == "__main__":
@@ -0,0 +1,294 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+# number of most frequent confusions and decimals of the scores in a summary
+TOP_CONFUSIONS = 5
+SUMMARY_DECIMALS = 4
+
+
+def sparsify(confmat):
+    """Encodes a flattened confusion matrix in a sparse COO format, which holds
+    the flat row-major indices and the values of all non-zero cells."""
+    confmat = np.asarray(confmat).ravel()
+    index = np.flatnonzero(confmat)
+    return {
+        "numclass": int(round(np.sqrt(confmat.size))),
+        "index": index.tolist(),
+        "value": confmat[index].tolist(),
+    }
+
+
+def densify(sparse):
+    """Decodes a sparse confusion matrix into a flattened dense array."""
+    value = np.asarray(sparse["value"])
+    dtype = value.dtype if value.size else np.int64
+    confmat = np.zeros(sparse["numclass"] ** 2, dtype=dtype)
+    confmat[np.asarray(sparse["index"], dtype=np.intp)] = value
+    return confmat
+
+
+def downcast_counts(confmats):
+    """Returns non-negative integer counts with the smallest unsigned dtype that
+    fits their maximum, other arrays are returned as they are."""
+    confmats = np.asarray(confmats)
+    if np.issubdtype(confmats.dtype, np.integer) and confmats.size:
+        if confmats.min() >= 0:
+            return confmats.astype(np.min_scalar_type(int(confmats.max())))
+    return confmats
+
+
+def get_confmat(epochdata):
+    """Returns the flattened dense confusion matrix of an epochdata entry, which
+    stores either a dense `confmat` or a sparse `confmat_sparse`."""
+    if "confmat_sparse" in epochdata:
+        return densify(epochdata["confmat_sparse"])
+    return np.asarray(epochdata["confmat"])
+
+
+def get_cells(epochdata):
+    """Returns the number of classes and the flat indices and values of the
+    non-zero cells of the confusion matrix of an epochdata entry, a sparse
+    `confmat_sparse` is not densified."""
+    if "confmat_sparse" in epochdata:
+        sparse = epochdata["confmat_sparse"]
+        index = np.asarray(sparse["index"], dtype=np.int64)
+        return sparse["numclass"], index, np.asarray(sparse["value"])
+
+    confmat = np.asarray(epochdata["confmat"]).ravel()
+    index = np.flatnonzero(confmat)
+    return int(round(np.sqrt(confmat.size))), index, confmat[index]
+
+
+def get_numclass(epochdata):
+    if "confmat_sparse" in epochdata:
+        return epochdata["confmat_sparse"]["numclass"]
+    return int(round(np.sqrt(len(epochdata["confmat"]))))
+
+
+def stack_confmats(epochdata):
+    """Stacks the confusion matrices of a list of epochdata entries into a
+    `(numepochs, numclass, numclass)` array."""
+    if not epochdata:
+        return np.zeros((0, 0, 0), dtype=np.int64)
+
+    numclass = get_numclass(epochdata[0])
+    confmats = np.asarray([get_confmat(entry) for entry in epochdata])
+    return confmats.reshape(len(epochdata), numclass, numclass)
+
+
+def compute_metrics(confmats):
+    """Computes the accuracy and the per-class precision, recall and F1 score
+    for every epoch of a `(numepochs, numclass, numclass)` array of confusion
+    matrices with the true classes in the rows.
+
+    Scores with a zero denominator are reported as 0.
+    """
+    truepositives = np.diagonal(confmats, axis1=1, axis2=2).astype(np.float64)
+    actual = confmats.sum(axis=2, dtype=np.float64)
+    predicted = confmats.sum(axis=1, dtype=np.float64)
+
+    precision = safe_divide(truepositives, predicted)
+    recall = safe_divide(truepositives, actual)
+    f1 = safe_divide(2 * precision * recall, precision + recall)
+    accuracy = safe_divide(truepositives.sum(axis=1), actual.sum(axis=1))
+
+    return {
+        "accuracy": accuracy,
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+    }
+
+
+def compute_accuracy(epochdata):
+    """Computes the accuracy of every entry of a list of epochdata entries from
+    the non-zero cells of its confusion matrix, the diagonal hits over the sum
+    of all cells, without stacking or densifying the matrices."""
+    hits, totals = [], []
+    for entry in epochdata:
+        numclass, index, value = get_cells(entry)
+        hits.append(value[index % (numclass + 1) == 0].sum(dtype=np.float64))
+        totals.append(value.sum(dtype=np.float64))
+    return safe_divide(np.asarray(hits), np.asarray(totals))
+
+
+def compare_confmats(reference, confmats, mode="diff"):
+    """Compares the `(numepochs, numclass, numclass)` confusion matrices of a
+    reference with a `(numfoldlogs, numepochs, numclass, numclass)` stack of
+    confusion matrices aligned to the same epochs.
+
+    Returns the difference (`mode="diff"`) or ratio (`mode="ratio"`, 0 where
+    the reference is 0) of every matrix to the reference and the differences of
+    the accuracy and per-class precision, recall and F1 score to the reference.
+    """
+    reference = np.asarray(reference)
+    confmats = np.asarray(confmats)
+    if mode == "ratio":
+        matrices = safe_divide(confmats, reference)
+    else:
+        matrices = confmats.astype(np.int64) - reference.astype(np.int64)
+
+    numfoldlogs, numepochs, numclass = confmats.shape[:3]
+    metrics = compute_metrics(confmats.reshape(-1, numclass, numclass))
+    referencemetrics = compute_metrics(reference)
+    deltas = dict()
+    for name, values in metrics.items():
+        values = values.reshape((numfoldlogs, numepochs) + values.shape[1:])
+        deltas[name] = values - referencemetrics[name]
+
+    return matrices, deltas
+
+
+def build_pyramid(confmats, factor=4):
+    """Aggregates a `(numepochs, numclass, numclass)` array of confusion
+    matrices over windows of `factor`, `factor**2`, ... consecutive epochs.
+
+    `confmats` is the array or an iterable of consecutive chunks of it whose
+    lengths are multiples of `factor` except for the last one, so that only a
+    single chunk is held in memory besides the aggregated windows.
+    Returns the levels 1, 2, ... up to the first level with a single window as
+    list of `(sums, counts)` with the summed confusion matrices and the number
+    of epochs of every window, the last window of a level may be shorter.
+    Every level is aggregated from the previous one.
+    """
+    if isinstance(confmats, np.ndarray):
+        confmats = [confmats]
+
+    sums, counts = [], []
+    for chunk in confmats:
+        chunk = np.asarray(chunk)
+        if not len(chunk):
+            continue
+        if np.issubdtype(chunk.dtype, np.integer):
+            chunk = chunk.astype(np.int64)
+        starts = np.arange(0, len(chunk), factor)
+        sums.append(np.add.reduceat(chunk, starts, axis=0))
+        counts.append(np.add.reduceat(np.ones(len(chunk), dtype=np.int64), starts))
+
+    if sum(int(chunkcounts.sum()) for chunkcounts in counts) <= 1:
+        return []
+
+    sums, counts = np.concatenate(sums), np.concatenate(counts)
+    levels = [(sums, counts)]
+    while len(sums) > 1:
+        starts = np.arange(0, len(sums), factor)
+        sums = np.add.reduceat(sums, starts, axis=0)
+        counts = np.add.reduceat(counts, starts)
+        levels.append((sums, counts))
+
+    return levels
+
+
+def build_sparse_pyramid(epochs, cells, values, numepochs, numclass, factor=4):
+    """Aggregates sparse confusion matrices like :py:func:`build_pyramid`
+    without densifying them.
+
+    The non-zero cells of all `numepochs` epochs are given as COO arrays of the
+    position of the epoch, the flat index of the cell and its value.
+    Every level is returned as `((windows, cells, values), counts)` with the
+    non-zero cells of the summed confusion matrices sorted by window and cell.
+    """
+    numcells = numclass * numclass
+    windows = np.asarray(epochs, dtype=np.int64)
+    cells = np.asarray(cells, dtype=np.int64)
+    values = np.asarray(values)
+    integer = values.size == 0 or np.issubdtype(values.dtype, np.integer)
+    counts = np.ones(numepochs, dtype=np.int64)
+
+    levels = []
+    while len(counts) > 1:
+        keys, inverse = np.unique(
+            (windows // factor) * numcells + cells, return_inverse=True
+        )
+        values = np.bincount(inverse.ravel(), weights=values, minlength=len(keys))
+        if integer:
+            values = np.rint(values).astype(np.int64)
+        windows, cells = np.divmod(keys, numcells)
+        counts = np.add.reduceat(counts, np.arange(0, len(counts), factor))
+        levels.append(((windows, cells, values), counts))
+
+    return levels
+
+
+def to_coo(epochdata):
+    """Returns the non-zero cells of the confusion matrices of a list of
+    epochdata entries as COO arrays of the position of the epoch, the flat
+    index of the cell and its value, sparse entries are not densified."""
+    epochs, cells, values = [], [], []
+    for position, entry in enumerate(epochdata):
+        index, value = get_cells(entry)[1:]
+        epochs.append(np.full(len(index), position, dtype=np.int64))
+        cells.append(index)
+        values.append(value)
+
+    if not epochs:
+        return (np.zeros(0, dtype=np.int64),) * 3
+    return np.concatenate(epochs), np.concatenate(cells), np.concatenate(values)
+
+
+def summarize(epochIds, accuracy, epochdata, topk=TOP_CONFUSIONS):
+    """Returns a compact summary of a foldlog from the `accuracy` at every
+    epoch in `epochIds` and the epochdata entry of the last epoch, which is not
+    densified if it is stored sparsely.
+
+    The summary holds the accuracy at the last and at the best epoch and the
+    `topk` most frequent confusions at the last epoch as indices of the actual
+    and predicted class, its size does not grow with the number of epochs or
+    classes.
+    """
+    accuracy = np.round(np.asarray(accuracy, dtype=np.float64), SUMMARY_DECIMALS)
+    numclass, index, value = get_cells(epochdata)
+    offdiagonal = (index % (numclass + 1) != 0) & (value > 0)
+    index, value = index[offdiagonal], value[offdiagonal]
+    top = np.lexsort((index, -value))[:topk]
+    best = int(np.argmax(accuracy))
+
+    return {
+        "final": {"epochId": epochIds[-1], "accuracy": accuracy[-1].item()},
+        "best": {"epochId": epochIds[best], "accuracy": accuracy[best].item()},
+        "topconfusions": [
+            {
+                "actual": int(index[i] // numclass),
+                "predicted": int(index[i] % numclass),
+                "count": value[i].item(),
+            }
+            for i in top
+        ],
+    }
+
+
+def extract_submatrix(confmats, indices):
+    """Extracts the confusion matrices between the classes in `indices` from a
+    `(numepochs, numclass, numclass)` array.
+
+    The returned `(numepochs, k + 1, k + 1)` array has an additional last row
+    and column aggregating all classes that are not in `indices`.
+    """
+    indices = np.asarray(indices, dtype=np.intp)
+    k = len(indices)
+    if np.issubdtype(confmats.dtype, np.floating):
+        dtype = np.float64
+    else:
+        dtype = np.int64
+
+    rows = np.asarray(confmats[:, indices, :], dtype=dtype)
+    submatrix = rows[:, :, indices]
+    colsums = confmats.sum(axis=1, dtype=dtype)[:, indices]
+    total = confmats.sum(axis=(1, 2), dtype=dtype)
+
+    result = np.zeros((confmats.shape[0], k + 1, k + 1), dtype=dtype)
+    result[:, :k, :k] = submatrix
+    result[:, :k, k] = rows.sum(axis=2) - submatrix.sum(axis=2)
+    result[:, k, :k] = colsums - submatrix.sum(axis=1)
+    result[:, k, k] = total - result.sum(axis=(1, 2))
+
+    return result
+
+
+def safe_divide(numerator, denominator):
+    result = np.zeros(np.broadcast(numerator, denominator).shape)
+    np.divide(numerator, denominator, out=result, where=denominator != 0)
+    return result
@@ -1,6 +1,21 @@
+from confusionflow.logging.accumulator import (
+    ConfusionAccumulator,
+    TorchConfusionAccumulator,
+)
+from confusionflow.logging.exporter import AsyncExporter
 from confusionflow.logging.fold import Fold
 from confusionflow.logging.foldlog import FoldLog
 from confusionflow.logging.foldlogdata import FoldLogData
+from confusionflow.logging.policy import LoggingPolicy
 from confusionflow.logging.run import Run
 
-__all__ = [Fold, FoldLog, FoldLogData, Run]
+__all__ = [
+    AsyncExporter,
+    ConfusionAccumulator,
+    Fold,
+    FoldLog,
+    FoldLogData,
+    LoggingPolicy,
+    Run,
+    TorchConfusionAccumulator,
+]
@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class ConfusionAccumulator:
+    """
+    A ConfusionAccumulator counts the predicted classes for each target class
+    in a confusion matrix with the targets in the rows.
+
+    Predictions can be added at once or batch by batch, each update costs a
+    single `np.bincount` over the batch.
+    """
+
+    def __init__(self, numclass):
+        self.numclass = numclass
+        self.counts = np.zeros(numclass * numclass, dtype=np.int64)
+
+    def update(self, targets, predictions):
+        targets = np.asarray(targets, dtype=np.int64).ravel()
+        predictions = np.asarray(predictions, dtype=np.int64).ravel()
+        if targets.shape != predictions.shape:
+            raise ValueError("targets and predictions must have the same length")
+        if targets.size == 0:
+            return
+
+        for labels in [targets, predictions]:
+            if labels.min() < 0 or labels.max() >= self.numclass:
+                raise ValueError(
+                    "labels must be in the range [0, {})".format(self.numclass)
+                )
+
+        self.counts += np.bincount(
+            targets * self.numclass + predictions, minlength=self.numclass**2
+        )
+
+    def reset(self):
+        self.counts[:] = 0
+
+    def value(self):
+        """Returns the `(numclass, numclass)` confusion matrix."""
+        return self.counts.reshape(self.numclass, self.numclass)
+
+    def tolist(self):
+        """Returns the flattened confusion matrix as expected by `add_epochdata`."""
+        return self.counts.tolist()
+
+
+class TorchConfusionAccumulator:
+    """
+    A TorchConfusionAccumulator counts the predicted classes for each target
+    class in a `numclass x numclass` tensor on `device`, e.g. the device of the
+    model.
+
+    Each batch is added with a single `scatter_add_` on the device, the counts
+    are only copied to the host when the confusion matrix is read.
+    Labels out of range are counted in an additional cell, so that they are
+    reported when the confusion matrix is read instead of synchronizing with
+    the device on every batch.
+    Requires PyTorch.
+    """
+
+    def __init__(self, numclass, device="cpu"):
+        import torch
+
+        self.numclass = numclass
+        self.counts = torch.zeros(
+            numclass * numclass + 1, dtype=torch.long, device=device
+        )
+
+    def update(self, targets, predictions):
+        targets = targets.reshape(-1).long()
+        predictions = predictions.reshape(-1).long()
+        if targets.shape != predictions.shape:
+            raise ValueError("targets and predictions must have the same length")
+        if targets.numel() == 0:
+            return
+
+        outside = (targets < 0) | (targets >= self.numclass)
+        outside |= (predictions < 0) | (predictions >= self.numclass)
+        index = targets * self.numclass + predictions
+        index = index.masked_fill(outside, self.numclass**2)
+        self.counts.scatter_add_(0, index, index.new_ones(index.shape))
+
+    def reset(self):
+        self.counts.zero_()
+
+    def read_counts(self):
+        """Copies the counts to the host, raises a ValueError if labels out of
+        range were added."""
+        counts = self.counts.cpu().numpy()
+        if counts[-1]:
+            raise ValueError(
+                "labels must be in the range [0, {})".format(self.numclass)
+            )
+        return counts[:-1]
+
+    def value(self):
+        """Returns the `(numclass, numclass)` confusion matrix as numpy array."""
+        return self.read_counts().reshape(self.numclass, self.numclass)
+
+    def tolist(self):
+        """Returns the flattened confusion matrix as expected by `add_epochdata`."""
+        return self.read_counts().tolist()
@@ -5,34 +5,159 @@ from __future__ import print_function
 import numpy as np
 import tensorflow as tf
 
+from confusionflow.logging.accumulator import ConfusionAccumulator
+from confusionflow.logging.scheduler import (
+    concatenate_inputs,
+    have_same_shape,
+    interleave_batches,
+    select_folds,
+    split_sizes,
+    take_rows,
+)
+
 
 class RunLogger(tf.keras.callbacks.Callback):
     """
     A Runlogger is a Keras Callback for evaluating the model performance on the
     specified folds and logging the confusion matrices.
+
+    The data of a fold can either be a tuple `(x, y)` of arrays, which is
+    predicted in batches of `batch_size`, `x` is a list or dict of arrays for
+    models with several inputs, or batches of `(x, y)` supplied by a
+    `tf.data.Dataset`, a `tf.keras.utils.Sequence` or a function returning a
+    new iterable over the batches for every epoch.
+    Each batch is added to a running confusion matrix, so only the predictions
+    of a single batch are kept in memory. All folds are evaluated in a single
+    pass over their batches.
+    The :py:class:`LoggingPolicy` of a fold selects the epochs and training
+    steps it is logged at and the instances it is evaluated on.
     """
 
-    def __init__(self, run, loss):
+    def __init__(self, run, loss, batch_size=256):
         self.run = run
         self.loss = loss
-        self.session = tf.Session()
+        self.batch_size = batch_size
+        self.iterators = dict()
+        self.epoch = 0
 
     def on_epoch_begin(self, epoch, logs={}):
-        for fold, foldlog in zip(self.run.folds, self.run.foldlogs):
-            assert fold.foldId == foldlog.foldId
+        self.epoch = epoch
+        folds, foldlogs = select_folds(
+            self.run, lambda policy: policy.should_log(epoch)
+        )
+        self.log_folds(folds, foldlogs, epoch)
+
+    def on_batch_end(self, batch, logs={}):
+        steps = self.get_steps()
+        folds, foldlogs = select_folds(
+            self.run, lambda policy: policy.should_log_step(batch, self.epoch, steps)
+        )
+        if folds:
+            epochId = self.epoch
+            if steps:
+                epochId = round(self.epoch + (batch + 1) / steps, 6)
+            self.log_folds(folds, foldlogs, epochId, step=batch)
+
+    def get_steps(self):
+        """Returns the number of training steps per epoch if known.
 
-            self.log_performance(fold, foldlog, epoch)
+        Entries logged within an epoch get the fractional epochId
+        `epoch + (step + 1) / steps`, or the current epoch if it is unknown.
+        """
+        steps = self.params.get("steps")
+        if not steps and self.params.get("samples") and self.params.get("batch_size"):
+            steps = int(np.ceil(self.params["samples"] / self.params["batch_size"]))
+        return steps
 
     def log_performance(self, fold, foldlog, epoch):
-        x, y = fold.data
-        predictions = np.argmax(self.model.predict(x, verbose=0), axis=1)
+        self.log_folds([fold], [foldlog], epoch)
+
+    def log_folds(self, folds, foldlogs, epoch, step=None):
+        """Evaluates all folds in a single pass, the next batches of all folds
+        are concatenated and predicted together if their shapes match."""
+        accumulators = [None] * len(folds)
+        batches = [
+            fold.get_policy().subsample_batches(
+                fold, self.iterate_batches(fold), self.get_targets
+            )
+            for fold in folds
+        ]
+        for tagged in interleave_batches(batches):
+            inputs = [x for _, (x, _) in tagged]
+            if have_same_shape(inputs):
+                probabilities = self.predict(concatenate_inputs(inputs, np.concatenate))
+                sections = np.cumsum(split_sizes(tagged))[:-1]
+                probabilities = np.split(probabilities, sections)
+            else:
+                probabilities = [self.predict(x) for x in inputs]
+
+            for (foldindex, (_, y)), batch_probabilities in zip(tagged, probabilities):
+                if accumulators[foldindex] is None:
+                    numclass = batch_probabilities.shape[1]
+                    accumulators[foldindex] = ConfusionAccumulator(numclass)
+                accumulators[foldindex].update(
+                    self.get_targets(y), np.argmax(batch_probabilities, axis=1)
+                )
+
+        for fold, foldlog, accumulator in zip(folds, foldlogs, accumulators):
+            if accumulator is not None:
+                foldlog.add_epochdata(
+                    epochId=epoch,
+                    confmat=accumulator.tolist(),
+                    policy=fold.get_policy_metadata(step),
+                )
+
+    def predict(self, x):
+        return np.asarray(self.model.predict_on_batch(x))
+
+    def get_targets(self, y):
         if self.loss == "categorical_crossentropy":
-            targets = np.argmax(y, axis=1)
+            return np.argmax(y, axis=1)
         elif self.loss == "sparse_categorical_crossentropy":
-            targets = y
+            return y
         else:
             raise ValueError("loss `{}` is not supported".format(self.loss))
-        confmat = tf.confusion_matrix(targets, predictions)
-        # transform tf.Tensor to list
-        confmat = confmat.eval(session=self.session).flatten().tolist()
-        foldlog.add_epochdata(epochId=epoch, confmat=confmat)
+
+    def iterate_batches(self, fold):
+        """Yields the `(x, y)` batches of the fold data."""
+        data = fold.data
+        if isinstance(data, tuple):
+            x, y = data
+            for start in range(0, len(y), self.batch_size):
+                batch = slice(start, start + self.batch_size)
+                yield take_rows(x, batch), y[batch]
+            return
+
+        if isinstance(data, tf.data.Dataset):
+            batches = self.iterate_dataset(fold.foldId, data)
+        elif isinstance(data, tf.keras.utils.Sequence):
+            batches = (data[i] for i in range(len(data)))
+        elif callable(data):
+            batches = data()
+        else:
+            batches = data
+
+        for batch in batches:
+            yield batch[0], batch[1]
+
+    def iterate_dataset(self, foldId, dataset):
+        if tf.executing_eagerly():
+            for x, y in dataset:
+                yield x.numpy(), y.numpy()
+            return
+
+        # in graph mode the iterator is created once per fold and re-initialized
+        # every epoch, so no new ops are added to the graph
+        if foldId not in self.iterators:
+            iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+            self.iterators[foldId] = (iterator, iterator.get_next())
+        iterator, next_batch = self.iterators[foldId]
+
+        session = tf.keras.backend.get_session()
+        session.run(iterator.initializer)
+        while True:
+            try:
+                x, y = session.run(next_batch)[:2]
+            except tf.errors.OutOfRangeError:
+                return
+            yield x, y
@@ -0,0 +1,90 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class AsyncExporter:
+    """
+    An AsyncExporter exports runs to `logdir` in a background thread, so that
+    the training loop is not blocked by serializing and writing the logs.
+
+    :py:meth:`export` queues a snapshot of the epochs logged so far. At most
+    `maxsize` snapshots are queued, further calls block until the writer thread
+    caught up. All files are written to a temporary file first and then renamed,
+    so the server never reads a partially written log.
+    Errors of the writer thread are raised by the next call to the exporter.
+
+    Training scripts have to call :py:meth:`close` (or use the exporter as a
+    context manager) before exiting to write all queued snapshots.
+    """
+
+    def __init__(self, logdir, storage="json", compress=False, maxsize=2):
+        self.logdir = logdir
+        self.storage = storage
+        self.compress = compress
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.write_snapshots)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def export(self, run):
+        """Queues a snapshot of `run` for export.
+
+        Like :py:meth:`Run.export` this ends streaming the run.
+        """
+        if self.closed:
+            raise ValueError("export on closed AsyncExporter")
+        self.raise_error()
+
+        snapshot = run.snapshot()
+        run.end_stream()
+        self.queue.put(snapshot)
+
+    def flush(self):
+        """Blocks until all queued snapshots are written."""
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        """Writes all queued snapshots and stops the writer thread."""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+    def write_snapshots(self):
+        while True:
+            snapshot = self.queue.get()
+            try:
+                if snapshot is None:
+                    return
+                if self.error is None:
+                    snapshot.export(
+                        self.logdir, storage=self.storage, compress=self.compress
+                    )
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
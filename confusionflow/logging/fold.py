@@ -2,14 +2,31 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from confusionflow.logging.policy import LoggingPolicy
+
+EVERY_EPOCH = LoggingPolicy()
+
 
 class Fold:
     """
-    A Fold is a subset of your dataset
+    A Fold is a subset of your dataset.
+
+    An optional :py:class:`LoggingPolicy` specifies when and on how many
+    instances the fold is evaluated, by default it is evaluated at every epoch.
     """
 
-    def __init__(self, data, foldId, dataset_config):
+    def __init__(self, data, foldId, dataset_config, policy=None):
         self.data = data
         self.foldId = foldId
         self.description = ""
         self.dataset_config = dataset_config
+        self.policy = policy
+
+    def get_policy(self):
+        return self.policy if self.policy is not None else EVERY_EPOCH
+
+    def get_policy_metadata(self, step=None):
+        """Returns the description of the policy recorded with each epoch."""
+        if self.policy is None:
+            return None
+        return self.policy.asdict(step)
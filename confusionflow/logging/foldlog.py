@@ -2,38 +2,97 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import json
+import copy
 import os
+import time
 
 from confusionflow.logging.utils import check_folderpath
-from confusionflow.logging.foldlogdata import FoldLogData
+from confusionflow.sqlitestore import is_sqlite_path, open_store
+from confusionflow.utils import write_json_atomic
+from confusionflow.logging.foldlogdata import FoldLogData, SPARSE_THRESHOLD
+
+# seconds between the updates of the foldlog and run JSON while streaming
+STREAM_UPDATE_INTERVAL = 10.0
 
 
 class FoldLog:
     """
     A FoldLog is a performance log of a model for a fold.
+
+    Its JSON holds a summary of the logged epochs, so that overviews do not
+    need to load the foldlog data.
     """
 
-    def __init__(self, foldlogId, runId, foldId):
+    def __init__(self, foldlogId, runId, foldId, sparse_threshold=SPARSE_THRESHOLD):
         self.foldlogId = foldlogId
         self.description = ""
         self.runId = runId
         self.foldId = foldId
-        self.foldlogdata = FoldLogData(foldlogId)
+        self.foldlogdata = FoldLogData(foldlogId, sparse_threshold)
+        self.streamdir = None
+        self.streamrun = None
+        self.streamupdated = 0.0
+
+    def add_epochdata(self, epochId, confmat, policy=None):
+        self.foldlogdata.add_epochdata(epochId, confmat, policy)
+
+        if self.streamrun is not None:
+            self.streamrun.update_stream()
+        elif self.streamdir is not None:
+            self.update_stream()
+
+    def stream(self, logdir, run=None):
+        """Exports the foldlog and appends every new epoch to its foldlog data.
 
-    def add_epochdata(self, epochId, confmat):
-        self.foldlogdata.add_epochdata(epochId, confmat)
+        The foldlog JSON is rewritten at most every `STREAM_UPDATE_INTERVAL`
+        seconds, by the Run `run` it belongs to if given.
+        """
+        self.export_foldlog(logdir)
+        self.foldlogdata.stream(logdir)
+        self.streamdir = logdir
+        self.streamrun = run
+        self.streamupdated = time.time()
+
+    def update_stream(self, force=False):
+        """Rewrites the foldlog JSON of a streamed foldlog if it is older than
+        `STREAM_UPDATE_INTERVAL` seconds or `force` is set."""
+        now = time.time()
+        if force or now - self.streamupdated >= STREAM_UPDATE_INTERVAL:
+            self.export_foldlog(self.streamdir)
+            self.streamupdated = now
+
+    def export(self, logdir, storage="json", compress=False):
+        self.export_foldlog(logdir)
+        self.foldlogdata.export(logdir, storage=storage, compress=compress)
+        self.streamdir = None
+        self.streamrun = None
+
+    def export_foldlog(self, logdir):
+        if is_sqlite_path(logdir):
+            open_store(logdir).put_foldlog(self.asdict())
+            return
 
-    def export(self, logdir):
         foldlog_path = check_folderpath(os.path.join(logdir, "foldlogs"))
         filepath = os.path.join(foldlog_path, self.foldlogId + ".json")
-        with open(filepath, "w") as outfile:
-            json.dump(self.asdict(), outfile)
+        write_json_atomic(filepath, self.asdict())
 
-        self.foldlogdata.export(logdir)
+    def snapshot(self):
+        """Returns a copy of the foldlog with a snapshot of its foldlog data."""
+        snapshot = copy.copy(self)
+        snapshot.foldlogdata = self.foldlogdata.snapshot()
+        snapshot.streamdir = None
+        snapshot.streamrun = None
+        return snapshot
+
+    def end_stream(self):
+        if self.streamdir is not None and self.streamrun is None:
+            self.update_stream(force=True)
+        self.streamdir = None
+        self.streamrun = None
+        self.foldlogdata.streampath = None
 
     def asdict(self):
-        return {
+        d = {
             "foldlogId": self.foldlogId,
             "description": self.description,
             "runId": self.runId,
@@ -41,3 +100,8 @@ class FoldLog:
             "foldlogdataId": self.foldlogdata.get_id() + "_data",
             "numepochs": self.foldlogdata.get_numepochs(),
         }
+        summary = self.foldlogdata.get_summary()
+        if summary is not None:
+            d["summary"] = summary
+
+        return d
@@ -2,29 +2,79 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
 import json
 import os
+import threading
 
-from confusionflow.logging.utils import check_folderpath
+import numpy as np
+
+from confusionflow.confmat import (
+    compute_accuracy,
+    downcast_counts,
+    sparsify,
+    stack_confmats,
+    summarize,
+)
+from confusionflow.sqlitestore import is_sqlite_path, open_store
+from confusionflow.utils import open_atomic, write_json_atomic
+from confusionflow.logging.utils import check_folderpath, remove_file, write_sidecar
+
+STORAGE_FORMATS = ("json", "npy")
+
+# confusion matrices of at least SPARSE_MIN_NUMCLASS classes with at most a
+# fraction `sparse_threshold` of non-zero cells are stored in a sparse format,
+# which is disabled by default because the web UI only reads dense matrices
+SPARSE_MIN_NUMCLASS = 100
+SPARSE_THRESHOLD = None
 
 
 class FoldLogData:
     """
     A FoldLogData is contains the EpochData for a specific FoldLog.
+
+    Epochs can be added from a background thread while the main thread exports
+    or summarizes them, `lock` keeps the epochs and the cached accuracies of
+    the summary in step.
     """
 
-    def __init__(self, foldlogId):
+    def __init__(self, foldlogId, sparse_threshold=SPARSE_THRESHOLD):
         self.foldlogId = foldlogId
         self.numepochs = 0
         self.epochdata = list()
+        self.streampath = None
+        self.sparse_threshold = sparse_threshold
+        self.accuracy = list()
+        self.lock = threading.RLock()
 
-    def add_epochdata(self, epochId, confmat):
+    def add_epochdata(self, epochId, confmat, policy=None):
+        """Adds the flattened confusion matrix `confmat` of epoch `epochId`.
+
+        Large matrices with few non-zero cells are stored as `confmat_sparse`
+        holding the flat indices and values of the non-zero cells.
+        `policy` describes the logging policy that produced the entry (see
+        :py:meth:`LoggingPolicy.asdict`).
+        """
         epochdata = dict()
         epochdata["epochId"] = epochId
-        epochdata["confmat"] = confmat
+        if self.is_sparse(confmat):
+            epochdata["confmat_sparse"] = sparsify(confmat)
+        else:
+            epochdata["confmat"] = confmat
+        if policy is not None:
+            epochdata["policy"] = policy
+
+        with self.lock:
+            self.epochdata.append(epochdata)
+            self.numepochs = len(self.epochdata)
 
-        self.epochdata.append(epochdata)
-        self.numepochs = len(self.epochdata)
+            if self.streampath is not None:
+                self.append_epochdata(epochdata)
+
+    def is_sparse(self, confmat):
+        if self.sparse_threshold is None or len(confmat) < SPARSE_MIN_NUMCLASS**2:
+            return False
+        return np.count_nonzero(confmat) <= self.sparse_threshold * len(confmat)
 
     def get_id(self):
         return self.foldlogId
@@ -32,11 +82,127 @@ class FoldLogData:
     def get_numepochs(self):
         return self.numepochs
 
-    def export(self, logdir):
+    def get_summary(self):
+        """Returns the summary of the epochs added so far (see
+        :py:func:`confusionflow.confmat.summarize`) or `None` without epochs.
+
+        The accuracies are only computed for the epochs added since the last
+        summary, from the stored dense or sparse matrices.
+        """
+        with self.lock:
+            if not self.epochdata:
+                return None
+
+            added = self.epochdata[slice(len(self.accuracy), None)]
+            if added:
+                self.accuracy.extend(compute_accuracy(added).tolist())
+
+            epochIds = [epochdata["epochId"] for epochdata in self.epochdata]
+            return summarize(epochIds, self.accuracy, self.epochdata[-1])
+
+    def stream(self, logdir):
+        """Streams the epochdata to `<foldlogId>_data.jsonl` in `<logdir>/foldlogdata`.
+
+        The file starts with a header line followed by one line per epoch.
+        Epochs added afterwards are appended to the file as they arrive.
+        For a SQLite `logdir` every epoch is inserted into the database.
+        """
+        if is_sqlite_path(logdir):
+            open_store(logdir).put_epochdata(self.foldlogId, self.epochdata)
+            self.streampath = logdir
+            return
+
+        foldlogdata_path = check_folderpath(os.path.join(logdir, "foldlogdata"))
+        basepath = os.path.join(foldlogdata_path, self.foldlogId + "_data")
+
+        with open(basepath + ".jsonl", "w") as outfile:
+            outfile.write(json.dumps({"foldlogId": self.foldlogId}) + "\n")
+            for epochdata in self.epochdata:
+                outfile.write(json.dumps(epochdata) + "\n")
+
+        for suffix in [".json", ".json.gz", ".npy", ".npy.gz", ".header.json"]:
+            remove_file(basepath + suffix)
+
+        self.streampath = basepath + ".jsonl"
+
+    def append_epochdata(self, epochdata):
+        if is_sqlite_path(self.streampath):
+            open_store(self.streampath).append_epochdata(self.foldlogId, epochdata)
+            return
+
+        with open(self.streampath, "a") as outfile:
+            outfile.write(json.dumps(epochdata) + "\n")
+
+    def export(self, logdir, storage="json", compress=False):
+        """Exports the epochdata to `<logdir>/foldlogdata`.
+
+        With `storage="json"` all epochs are written to `<foldlogId>_data.json`.
+        With `storage="npy"` the confusion matrices are stored as a single dense
+        `(numepochs, numclass, numclass)` array in `<foldlogId>_data.npy` and the
+        remaining metadata in `<foldlogId>_data.header.json`.
+        The export ends streaming and replaces the streamed `.jsonl` file.
+        With `compress=True` a gzip compressed `.gz` sidecar is written as well.
+        """
+        if storage not in STORAGE_FORMATS:
+            raise ValueError("storage `{}` is not supported".format(storage))
+
+        if is_sqlite_path(logdir):
+            open_store(logdir).put_epochdata(self.foldlogId, self.epochdata)
+            self.streampath = None
+            return
+
         foldlogdata_path = check_folderpath(os.path.join(logdir, "foldlogdata"))
-        filepath = os.path.join(foldlogdata_path, self.foldlogId + "_data.json")
-        with open(filepath, "w") as outfile:
-            json.dump(self.asdict(), outfile)
+        basepath = os.path.join(foldlogdata_path, self.foldlogId + "_data")
+
+        if storage == "npy":
+            self.export_npy(basepath)
+            write_sidecar(basepath + ".npy", compress)
+            remove_file(basepath + ".json")
+            remove_file(basepath + ".json.gz")
+        else:
+            write_json_atomic(basepath + ".json", self.asdict())
+            write_sidecar(basepath + ".json", compress)
+            remove_file(basepath + ".npy")
+            remove_file(basepath + ".npy.gz")
+            remove_file(basepath + ".header.json")
+
+        remove_file(basepath + ".jsonl")
+        self.streampath = None
+
+    def export_npy(self, basepath):
+        confmats = self.asarray()
+        with open_atomic(basepath + ".npy", "wb") as outfile:
+            np.save(outfile, confmats)
+
+        header = dict()
+        header["foldlogId"] = self.foldlogId
+        header["numepochs"] = self.numepochs
+        header["numclass"] = int(confmats.shape[1])
+        header["dtype"] = confmats.dtype.name
+        header["epochIds"] = [epochdata["epochId"] for epochdata in self.epochdata]
+        policies = [epochdata.get("policy") for epochdata in self.epochdata]
+        if any(policy is not None for policy in policies):
+            header["policies"] = policies
+        write_json_atomic(basepath + ".header.json", header)
+
+    def snapshot(self):
+        """Returns a copy holding the epochs added so far, which can be
+        exported while new epochs are added to this FoldLogData."""
+        with self.lock:
+            snapshot = copy.copy(self)
+            snapshot.epochdata = list(self.epochdata)
+            snapshot.accuracy = list(self.accuracy)
+        snapshot.numepochs = len(snapshot.epochdata)
+        snapshot.streampath = None
+        snapshot.lock = threading.RLock()
+        return snapshot
+
+    def asarray(self):
+        """Returns the confusion matrices as `(numepochs, numclass, numclass)` array.
+
+        Integer counts are stored with the smallest unsigned dtype that fits.
+        """
+        return downcast_counts(stack_confmats(self.epochdata))
 
     def asdict(self):
         d = dict()
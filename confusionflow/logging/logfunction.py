@@ -1,28 +1,136 @@
+import concurrent.futures
+import copy
+
 import torch
-import torchnet as tnt
 
+from confusionflow.logging.accumulator import TorchConfusionAccumulator
+from confusionflow.logging.scheduler import (
+    have_same_shape,
+    interleave_batches,
+    select_folds,
+    split_sizes,
+)
+
+executor = None
+# the epoch evaluated on the background thread, at most one is pending
+pending = None
+
+
+def log_epoch(run, model, device, epoch, numclass, background=False):
+    """Logs the confusion matrices of `model` for all folds of `run` whose
+    logging policy selects epoch `epoch`.
+
+    The folds are evaluated in a single pass: in each round the next batch of
+    every fold is concatenated and predicted together and the predictions are
+    added to the accumulator of their fold.
+
+    With `background=True` a copy of the model is evaluated on a background
+    thread while training continues. A `concurrent.futures.Future` is returned,
+    which should be waited for before exporting the run. The next call waits
+    for the pending evaluation before copying the model, so that at most one
+    copy is kept if the evaluation is slower than training.
+    """
+    folds, foldlogs = select_folds(run, lambda policy: policy.should_log(epoch))
+    return evaluate(folds, foldlogs, model, device, epoch, numclass, None, background)
+
+
+def log_step(
+    run, model, device, epoch, step, numclass, steps_per_epoch=None, background=False
+):
+    """Logs the folds of `run` whose logging policy selects training step `step`
+    (counted from 0) of epoch `epoch`, see :py:func:`log_epoch`.
+
+    With `steps_per_epoch` the entries are logged with the fractional epochId
+    `epoch + (step + 1) / steps_per_epoch`, otherwise with `epoch`.
+    The step is recorded in the policy of the entries.
+    """
+    folds, foldlogs = select_folds(
+        run, lambda policy: policy.should_log_step(step, epoch, steps_per_epoch)
+    )
+    epochId = epoch
+    if steps_per_epoch:
+        epochId = round(epoch + (step + 1) / steps_per_epoch, 6)
+    return evaluate(folds, foldlogs, model, device, epochId, numclass, step, background)
+
+
+def evaluate(folds, foldlogs, model, device, epochId, numclass, step, background):
+    global pending
 
-def log_epoch(run, model, device, epoch, numclass):
-    for fold, foldlog in zip(run.folds, run.foldlogs):
-        assert fold.foldId == foldlog.foldId
+    if not folds:
+        return None
 
-        data_loader = fold.data
-        log_performance(foldlog, model, device, data_loader, epoch, numclass)
+    data_loaders = [
+        fold.get_policy().subsample_batches(fold, fold.data, get_labels)
+        for fold in folds
+    ]
+    policies = [fold.get_policy_metadata(step) for fold in folds]
+    # epochs are added in order and at most one copy of the model is pending
+    wait_pending()
+    if background:
+        model = copy.deepcopy(model)
+        pending = get_executor().submit(
+            log_folds,
+            foldlogs,
+            model,
+            device,
+            data_loaders,
+            epochId,
+            numclass,
+            policies,
+        )
+        return pending
+
+    log_folds(foldlogs, model, device, data_loaders, epochId, numclass, policies)
 
 
 def log_performance(foldlog, model, device, data_loader, epoch, numclass):
+    log_folds([foldlog], model, device, [data_loader], epoch, numclass)
+
+
+def log_folds(foldlogs, model, device, data_loaders, epoch, numclass, policies=None):
     model.eval()
 
-    confusion_matrix = tnt.meter.ConfusionMeter(numclass)
+    confusion_matrices = [TorchConfusionAccumulator(numclass, device) for _ in foldlogs]
 
     with torch.no_grad():
-        for data, target in data_loader:
-            data, target = data.to(device), target.to(device)
-            output = model(data)
-            pred = output.max(1, keepdim=True)[1]
+        for tagged in interleave_batches(data_loaders):
+            inputs = [data for _, (data, _) in tagged]
+            if have_same_shape(inputs):
+                output = model(torch.cat(inputs).to(device))
+                preds = output.argmax(dim=1).split(split_sizes(tagged))
+            else:
+                preds = [model(data.to(device)).argmax(dim=1) for data in inputs]
 
-            confusion_matrix.add(pred.data.squeeze(), target.long())
+            for (foldindex, (_, target)), pred in zip(tagged, preds):
+                confusion_matrices[foldindex].update(target.to(device), pred)
 
-    foldlog.add_epochdata(
-        epochId=epoch, confmat=confusion_matrix.conf.flatten().tolist()
-    )
+    if policies is None:
+        policies = [None] * len(foldlogs)
+    for foldlog, confusion_matrix, policy in zip(
+        foldlogs, confusion_matrices, policies
+    ):
+        foldlog.add_epochdata(
+            epochId=epoch, confmat=confusion_matrix.tolist(), policy=policy
+        )
+
+
+def get_labels(target):
+    return target.cpu().numpy()
+
+
+def wait_pending():
+    """Waits for the pending background evaluation, its errors are raised."""
+    global pending
+
+    if pending is not None:
+        future, pending = pending, None
+        future.result()
+
+
+def get_executor():
+    """Returns the single background thread, which logs the epochs in order."""
+    global executor
+
+    if executor is None:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    return executor
@@ -0,0 +1,214 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from confusionflow.logging.scheduler import take_rows
+from confusionflow.logging.utils import read_dataset_config
+
+
+class LoggingPolicy:
+    """
+    A LoggingPolicy specifies when and on how many instances a fold is evaluated.
+
+    By default a fold is logged at every epoch. With `every=k` only every k-th
+    epoch is logged, with `base=b` the epochs 0, 1 and the powers of `b`
+    (e.g. 1, 2, 4, 8, ... for `b=2`), with `every=None` no epochs are logged.
+    With `every_steps=n` the fold is additionally logged after every n-th
+    training step within an epoch.
+    With `subsample=n` only n instances of the fold are evaluated, a random
+    sample stratified by the class frequencies of the fold in the dataset
+    template. The sample is drawn with the random `seed`, so that every epoch
+    evaluates the same instances as long as the batches come in the same order.
+
+    The policy is recorded in every epochdata entry it produces.
+    """
+
+    def __init__(self, every=1, base=None, subsample=None, every_steps=None, seed=0):
+        if base is not None and base <= 1:
+            raise ValueError("base must be greater than 1")
+        self.every = every
+        self.base = base
+        self.subsample = subsample
+        self.every_steps = every_steps
+        self.seed = seed
+        self.quotas = dict()
+
+    def should_log(self, epoch):
+        """Returns whether the fold is logged at epoch `epoch`."""
+        if self.base is not None:
+            return epoch in geometric_schedule(self.base, epoch)
+        if self.every is None:
+            return False
+        return epoch % self.every == 0
+
+    def should_log_step(self, step, epoch=None, steps_per_epoch=None):
+        """Returns whether the fold is logged after training step `step` of
+        epoch `epoch`, counted from 0.
+
+        The last step of an epoch is skipped if the next epoch is logged, which
+        evaluates the same model.
+        """
+        if self.every_steps is None:
+            return False
+        if steps_per_epoch and step + 1 >= steps_per_epoch and epoch is not None:
+            if self.should_log(epoch + 1):
+                return False
+        return (step + 1) % self.every_steps == 0
+
+    def subsample_batches(self, fold, batches, get_labels):
+        """Yields the `(x, y)` batches restricted to the stratified subsample.
+
+        Every class is sampled uniformly at random up to its quota (see
+        :py:class:`StratifiedReservoir`), so all batches are read before the
+        sampled instances are yielded in the order of the batches.
+        `get_labels` returns the class indices of a batch `y` as numpy array.
+        """
+        if self.subsample is None:
+            for batch in batches:
+                yield batch
+            return
+
+        reservoir = StratifiedReservoir(self.get_quotas(fold), self.seed)
+        for x, y in batches:
+            reservoir.add(x, y, np.asarray(get_labels(y), dtype=np.intp))
+        for batch in reservoir.batches():
+            yield batch
+
+    def get_quotas(self, fold):
+        if fold.foldId not in self.quotas:
+            frequencies = read_classfrequencies(fold.dataset_config, fold.foldId)
+            self.quotas[fold.foldId] = allocate_quotas(frequencies, self.subsample)
+        return self.quotas[fold.foldId]
+
+    def asdict(self, step=None):
+        d = dict()
+        if self.base is not None:
+            d["base"] = self.base
+        elif self.every is not None:
+            d["every"] = self.every
+        for key in ["subsample", "every_steps"]:
+            if getattr(self, key) is not None:
+                d[key] = getattr(self, key)
+        if self.subsample is not None and self.seed is not None:
+            d["seed"] = self.seed
+        if step is not None:
+            d["step"] = step
+
+        return d
+
+
+def geometric_schedule(base, maxepoch):
+    """Returns the set of epochs up to `maxepoch` in the geometric schedule."""
+    epochs = {0}
+    value = 1.0
+    while value <= maxepoch:
+        epochs.add(int(value))
+        value *= base
+    return epochs
+
+
+class StratifiedReservoir:
+    """
+    A StratifiedReservoir draws a uniform random sample of `quotas[c]`
+    instances of every class `c` from a stream of batches in a single pass
+    (reservoir sampling).
+
+    Each class has `quotas[c]` slots. The first instances of a class fill its
+    slots, the n-th instance after that replaces a random slot with
+    probability `quotas[c] / n`. Only the rows of a batch that were sampled are
+    kept, so the memory is bounded by the sampled instances.
+    """
+
+    def __init__(self, quotas, seed=None):
+        self.quotas = np.asarray(quotas, dtype=np.intp)
+        self.offsets = np.cumsum(self.quotas) - self.quotas
+        self.slots = np.full(int(self.quotas.sum()), -1, dtype=np.intp)
+        self.seen = np.zeros(len(self.quotas), dtype=np.intp)
+        self.random = np.random.RandomState(seed)
+        self.numinstances = 0
+        self.chunks = []
+
+    def add(self, x, y, labels):
+        """Samples from the batch `(x, y)` with the class indices `labels`,
+        instances of unknown classes are skipped."""
+        labels = labels.ravel()
+        ids = self.numinstances + np.arange(len(labels))
+        self.numinstances += len(labels)
+
+        rows = np.flatnonzero((labels >= 0) & (labels < len(self.quotas)))
+        classes = labels[rows]
+        # position of each instance among all instances of its class so far
+        position = self.seen[classes] + rank_within_class(classes)
+        self.seen += np.bincount(classes, minlength=len(self.quotas))
+
+        slot = position.copy()
+        full = position >= self.quotas[classes]
+        slot[full] = np.floor(
+            self.random.random_sample(np.count_nonzero(full)) * (position[full] + 1)
+        ).astype(np.intp)
+        sampled = slot < self.quotas[classes]
+        if not sampled.any():
+            return
+
+        slots = self.offsets[classes[sampled]] + slot[sampled]
+        rows = rows[sampled]
+        # a later instance of the batch replaces an earlier one in the same slot
+        _, last = np.unique(slots[::-1], return_index=True)
+        keep = np.sort(len(slots) - 1 - last)
+        self.slots[slots[keep]] = ids[rows[keep]]
+
+        rows = rows[keep]
+        self.chunks.append((take_rows(x, rows), y[rows], ids[rows]))
+
+    def batches(self):
+        """Yields the `(x, y)` rows of the sample in the order they were added."""
+        sampled = self.slots[self.slots >= 0]
+        for x, y, ids in self.chunks:
+            rows = np.flatnonzero(np.isin(ids, sampled))
+            if len(rows):
+                yield take_rows(x, rows), y[rows]
+
+
+def rank_within_class(labels):
+    """Returns the rank of each label among the equal labels before it."""
+    order = np.argsort(labels, kind="stable")
+    sortedlabels = labels[order]
+    starts = np.searchsorted(sortedlabels, sortedlabels, side="left")
+    rank = np.empty(len(labels), dtype=np.intp)
+    rank[order] = np.arange(len(labels)) - starts
+    return rank
+
+
+def allocate_quotas(frequencies, size):
+    """Divides `size` instances among the classes proportional to their
+    `frequencies` using the largest remainder method."""
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    total = frequencies.sum()
+    if total == 0:
+        return np.zeros(len(frequencies), dtype=np.intp)
+
+    size = min(size, int(total))
+    exact = frequencies * size / total
+    quotas = np.floor(exact).astype(np.intp)
+    remainder = size - quotas.sum()
+    quotas[np.argsort(quotas - exact, kind="stable")[:remainder]] += 1
+    return quotas
+
+
+def read_classfrequencies(template_file_path, foldId):
+    """Returns the instance counts per class of fold `foldId` as given in the
+    dataset template, in the order of the classes of the dataset."""
+    config = read_dataset_config(template_file_path)
+    for fold in config["folds"]:
+        if fold["foldId"] != foldId:
+            continue
+
+        frequencies = np.zeros(config["numclass"], dtype=np.int64)
+        for classcount in fold["classcounts"]:
+            index = config["classes"].index(classcount["classname"])
+            frequencies[index] = classcount["instancecount"]
+        return frequencies
+
+    raise ValueError("fold `{}` not found in `{}`".format(foldId, template_file_path))
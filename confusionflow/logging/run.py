@@ -2,65 +2,159 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import json
+import copy
 import os
+import time
 
 from confusionflow.logging.utils import (
     check_folderpath,
     update_runindex,
-    update_datasetindex,
     create_logdir,
     create_dataset_config,
+    write_sidecar,
 )
 from confusionflow.logging import FoldLog
+from confusionflow.logging.foldlog import STREAM_UPDATE_INTERVAL
+from confusionflow.logging.foldlogdata import SPARSE_THRESHOLD
+from confusionflow.sqlitestore import is_sqlite_path, open_store
+from confusionflow.utils import write_json_atomic
 
 
 class Run:
     """
     Run is a simple wrapper for simplifying the logging of an experiment.
+
+    The `hyperparam` dict holds the hyperparameters of the experiment, runs
+    can be filtered by them in the server's run listing.
     """
 
-    def __init__(self, runId, folds, trainfoldId):
+    def __init__(
+        self,
+        runId,
+        folds,
+        trainfoldId,
+        sparse_threshold=SPARSE_THRESHOLD,
+        hyperparam=None,
+    ):
         self.runId = runId
         self.folds = folds
         self.trainfoldId = trainfoldId
+        self.sparse_threshold = sparse_threshold
+        self.hyperparam = dict(hyperparam or {})
         self.foldlogs = list()
+        self.streamdir = None
+        self.streamupdated = 0.0
 
         for fold in self.folds:
             foldlog = self.create_foldlog(fold.foldId)
             self.foldlogs.append(foldlog)
 
-    def get_keras_callback(self, loss):
+    def get_keras_callback(self, loss, batch_size=256):
         from confusionflow.logging.callbacks import RunLogger
 
-        runlogger = RunLogger(self, loss)
+        runlogger = RunLogger(self, loss, batch_size=batch_size)
         return runlogger
 
-    def export(self, logdir):
+    def export(self, logdir, storage="json", compress=False):
+        """Exports the run, its foldlogs and the dataset configs to `logdir`.
+
+        `storage` selects the format of the foldlog data, either `"json"` or the
+        binary `"npy"` format (see :py:meth:`FoldLogData.export`).
+        With `compress=True` gzip compressed `.gz` sidecars of the run and the
+        foldlog data are written, which the server sends to clients as is.
+        If `logdir` is a `.db`, `.sqlite` or `.sqlite3` file, the run is stored in
+        a single SQLite database instead and `storage` and `compress` are
+        ignored.
+        """
+        self.streamdir = None
+        self.export_run(logdir, compress=compress)
+
+        for foldlog in self.foldlogs:
+            foldlog.export(logdir, storage=storage, compress=compress)
+
+    def stream(self, logdir):
+        """Exports the run to `logdir` and streams every new epoch to disk.
+
+        Each call to :py:meth:`FoldLog.add_epochdata` afterwards appends a single
+        line to `<foldlogId>_data.jsonl` so that the server can show the progress
+        while training and no epochs are lost if training crashes. The foldlogs,
+        the run and its entry in the run index are updated at most every
+        `STREAM_UPDATE_INTERVAL` seconds and when streaming ends.
+        A final :py:meth:`export` replaces the streamed files.
+        """
+        self.export_run(logdir)
+
+        for foldlog in self.foldlogs:
+            foldlog.stream(logdir, run=self)
+        self.streamdir = logdir
+        self.streamupdated = time.time()
+
+    def update_stream(self, force=False):
+        """Rewrites the foldlogs, the run and its entry in the run index of a
+        streamed run if they are older than `STREAM_UPDATE_INTERVAL` seconds or
+        `force` is set."""
+        now = time.time()
+        if self.streamdir is None:
+            return
+        if not force and now - self.streamupdated < STREAM_UPDATE_INTERVAL:
+            return
+
+        for foldlog in self.foldlogs:
+            if foldlog.streamdir is not None:
+                foldlog.export_foldlog(foldlog.streamdir)
+        self.update_run(self.streamdir)
+        self.streamupdated = now
+
+    def export_run(self, logdir, compress=False):
+        self.update_run(logdir, compress=compress)
+
+        for fold in self.folds:
+            create_dataset_config(logdir, fold.dataset_config)
+
+    def update_run(self, logdir, compress=False):
+        """Writes the run and its entry in the run index to `logdir`."""
+        rundict = self.asdict()
+        rundict["exported"] = time.time()
+
+        if is_sqlite_path(logdir):
+            open_store(logdir).put_run(rundict)
+            return
+
         create_logdir(logdir)
         run_path = check_folderpath(os.path.join(logdir, "runs"))
         filepath = os.path.join(run_path, self.runId + ".json")
-        with open(filepath, "w") as outfile:
-            json.dump(self.asdict(), outfile)
+        write_json_atomic(filepath, rundict)
+        write_sidecar(filepath, compress)
 
-        update_runindex(logdir)
+        update_runindex(logdir, rundict)
 
-        for fold in self.folds:
-            create_dataset_config(logdir, fold.dataset_config)
-        update_datasetindex(logdir)
+    def snapshot(self):
+        """Returns a copy of the run holding the epochs logged so far, which can
+        be exported in the background while training continues.
+
+        Only the epochdata lists are copied, the logged epochs themselves are
+        never modified.
+        """
+        snapshot = copy.copy(self)
+        snapshot.foldlogs = [foldlog.snapshot() for foldlog in self.foldlogs]
+        snapshot.streamdir = None
+        return snapshot
 
+    def end_stream(self):
+        self.update_stream(force=True)
+        self.streamdir = None
         for foldlog in self.foldlogs:
-            foldlog.export(logdir)
+            foldlog.end_stream()
 
     def create_foldlog(self, foldId):
         foldlogId = self.runId + "_" + foldId
-        return FoldLog(foldlogId, self.runId, foldId)
+        return FoldLog(foldlogId, self.runId, foldId, self.sparse_threshold)
 
     def asdict(self):
         d = dict()
         d["runId"] = self.runId
         d["trainfoldId"] = self.trainfoldId
-        d["hyperparam"] = dict()
+        d["hyperparam"] = dict(self.hyperparam)
         d["foldlogs"] = []
         for foldlog in self.foldlogs:
             d["foldlogs"].append(foldlog.asdict())
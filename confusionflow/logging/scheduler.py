@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+
+def select_folds(run, should_log):
+    """Returns the folds and foldlogs of `run` selected by their policies."""
+    folds, foldlogs = [], []
+    for fold, foldlog in zip(run.folds, run.foldlogs):
+        assert fold.foldId == foldlog.foldId
+        if should_log(fold.get_policy()):
+            folds.append(fold)
+            foldlogs.append(foldlog)
+
+    return folds, foldlogs
+
+
+def interleave_batches(iterables):
+    """Yields lists of `(foldindex, batch)` with the next batch of every fold that
+    has batches left, so that all folds are evaluated in a single pass.
+
+    The batches of one round can be concatenated and predicted together, the
+    `foldindex` tags tell which accumulator the predictions belong to.
+    """
+    iterators = [iter(iterable) for iterable in iterables]
+    active = list(range(len(iterators)))
+    while active:
+        tagged = []
+        for foldindex in list(active):
+            try:
+                tagged.append((foldindex, next(iterators[foldindex])))
+            except StopIteration:
+                active.remove(foldindex)
+
+        if tagged:
+            yield tagged
+
+
+def split_sizes(tagged):
+    """Returns the batch sizes of a round of tagged `(x, y)` batches."""
+    return [len(batch[1]) for _, batch in tagged]
+
+
+def have_same_shape(arrays):
+    """Checks whether the batches can be concatenated along the first axis,
+    batches of multi-input models need the same inputs of the same shapes."""
+    structures = [get_structure(x) for x in arrays]
+    return all(structure == structures[0] for structure in structures)
+
+
+def get_structure(x):
+    """Returns the names and the shapes without the first axis of the inputs
+    in a batch `x`."""
+    if isinstance(x, dict):
+        return [(name, tuple(x[name].shape[1:])) for name in sorted(x)]
+    if isinstance(x, (list, tuple)):
+        return [(index, tuple(a.shape[1:])) for index, a in enumerate(x)]
+    return tuple(x.shape[1:])
+
+
+def map_inputs(func, x):
+    """Applies `func` to every input array of a batch `x`, which is a single
+    array or a list, tuple or dict of arrays for multi-input models."""
+    if isinstance(x, dict):
+        return dict((name, func(a)) for name, a in x.items())
+    if isinstance(x, (list, tuple)):
+        return type(x)(func(a) for a in x)
+    return func(x)
+
+
+def take_rows(x, rows):
+    """Returns the instances `rows`, an index or a slice, of a batch `x`."""
+    return map_inputs(lambda a: a[rows], x)
+
+
+def concatenate_inputs(inputs, concatenate):
+    """Concatenates the batches `inputs` of equal structure input by input with
+    `concatenate`, e.g. `np.concatenate`."""
+    first = inputs[0]
+    if isinstance(first, dict):
+        return dict((name, concatenate([x[name] for x in inputs])) for name in first)
+    if isinstance(first, (list, tuple)):
+        return type(first)(
+            concatenate([x[index] for x in inputs]) for index in range(len(first))
+        )
+    return concatenate(inputs)
@@ -2,13 +2,26 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import gzip
 import json
 import os
 
 import yaml
 
+from confusionflow.sqlitestore import is_sqlite_path, open_store
+from confusionflow.utils import open_atomic, write_json_atomic
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
 
 def create_logdir(logdir):
+    if is_sqlite_path(logdir):
+        return
+
     logdir = os.path.realpath(logdir)
     if not os.path.exists(logdir):
         os.mkdir(logdir)
@@ -17,14 +30,27 @@ def create_logdir(logdir):
 
 
 def create_dataset_config(logdir, template_file_path):
+    export_dict = read_dataset_config(template_file_path)
+    if is_sqlite_path(logdir):
+        open_store(logdir).put_dataset(export_dict)
+        return
+
+    datasetfolder = logdir + "/datasets/"
+    filename = export_dict["datasetId"] + ".json"
+    write_json_atomic(datasetfolder + filename, export_dict)
+
+    update_datasetindex(logdir, export_dict)
+
+
+def read_dataset_config(template_file_path):
+    """Converts the dataset template into the dataset config of the logdir."""
     if not os.path.exists(os.path.realpath(template_file_path)):
         raise OSError(
             "Error! File `{}` not found!".format(os.path.realpath(template_file_path))
         )
 
     with open(template_file_path) as f:
-        content = f.read()
-        data = yaml.load(content)
+        data = yaml.safe_load(f)
 
     export_dict = dict()
     export_dict["datasetId"] = data["dataset"]
@@ -53,12 +79,7 @@ def create_dataset_config(logdir, template_file_path):
 
         export_dict["folds"].append(export_fold)
 
-    datasetfolder = logdir + "/datasets/"
-    filename = data["dataset"] + ".json"
-    with open(datasetfolder + filename, "w") as outfile:
-        outfile.write(json.dumps(export_dict))
-
-    update_datasetindex(logdir)
+    return export_dict
 
 
 def check_folderpath(folderpath):
@@ -69,26 +90,85 @@ def check_folderpath(folderpath):
         raise OSError("Error! Please specify a valid folder {}".format(folderpath))
 
 
-def update_runindex(logdir):
-    runfolder = logdir + "/runs/"
-    runfiles = os.listdir(runfolder)
+def remove_file(filepath):
+    """Removes a file written by a previous export with another storage format."""
+    if os.path.isfile(filepath):
+        os.remove(filepath)
 
-    update_index(runfolder, runfiles)
 
+def write_sidecar(filepath, compress):
+    """Writes a gzip compressed copy `<filepath>.gz` that the server can send to
+    clients without compressing on every request or removes a stale copy."""
+    if compress:
+        with open(filepath, "rb") as infile:
+            with open_atomic(filepath + ".gz", "wb") as outfile:
+                with gzip.GzipFile(fileobj=outfile, mode="wb") as gzipfile:
+                    gzipfile.write(infile.read())
+    else:
+        remove_file(filepath + ".gz")
 
-def update_datasetindex(logdir):
-    datasetfolder = logdir + "/datasets/"
-    datasetfiles = os.listdir(datasetfolder)
 
-    update_index(datasetfolder, datasetfiles)
+def update_runindex(logdir, run=None):
+    """Adds `run` to the run index or rebuilds the index if no run is given."""
+    runfolder = logdir + "/runs/"
+    if run is None:
+        update_index(runfolder, os.listdir(runfolder))
+    else:
+        update_index_entry(runfolder, run, "runId")
+
+
+def update_datasetindex(logdir, dataset=None):
+    """Adds `dataset` to the dataset index or rebuilds the index if no dataset
+    is given."""
+    datasetfolder = logdir + "/datasets/"
+    if dataset is None:
+        update_index(datasetfolder, os.listdir(datasetfolder))
+    else:
+        update_index_entry(datasetfolder, dataset, "datasetId")
 
 
 def update_index(folder, files):
-    index = []
-    for file in files:
-        if file != "index.json":
-            with open(folder + file, "r") as f:
-                index.append(json.loads(f.read()))
+    with lock_index(folder):
+        write_json_atomic(folder + "index.json", read_entries(folder, files))
+
 
-    with open(folder + "index.json", "w") as f:
-        f.write(json.dumps(index))
+def update_index_entry(folder, entry, key):
+    """Replaces the entry with the same `key` in `index.json` or appends it.
+
+    Only the index itself is read, the index is rebuilt from all files in
+    `folder` if it does not exist yet.
+    """
+    with lock_index(folder):
+        if os.path.isfile(folder + "index.json"):
+            with open(folder + "index.json", "r") as f:
+                index = json.loads(f.read())
+        else:
+            index = read_entries(folder, os.listdir(folder))
+
+        index = [item for item in index if item[key] != entry[key]]
+        index.append(entry)
+
+        write_json_atomic(folder + "index.json", index)
+
+
+def read_entries(folder, files):
+    entries = []
+    for file in sorted(files):
+        if file.endswith(".json") and file != "index.json":
+            with open(folder + file, "r") as f:
+                entries.append(json.loads(f.read()))
+
+    return entries
+
+
+@contextlib.contextmanager
+def lock_index(folder):
+    """Serializes index updates of several processes exporting to `folder`."""
+    with open(os.path.join(folder, ".index.lock"), "a") as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
@@ -8,22 +8,65 @@ from flask import Flask
 
 import confusionflow
 from confusionflow.server.blueprints import api, web
+from confusionflow.server.cache import FileCache
+from confusionflow.server.diskcache import DiskCache
+from confusionflow.server.logdir import LogDirRegistry
+from confusionflow.server.pool import CPUPool
+from confusionflow.server.utils import compress_response
 from confusionflow.utils import check_folderpath, get_logdir_from_env
 
 
-def create_app(logdir=None):
+def create_app(logdir=None, logdirs=None, rootdir=None, config=None):
+    """Creates the ConfusionFlow app serving one or several log directories.
+
+    `logdir` is served under `/api`, `logdirs` maps names to log directories
+    and `rootdir` is a directory of log directories, which are served under
+    `/api/<name>` by the name of their subdirectory.
+    A single named log directory is also served under `/api`.
+    Without any log directory `logdir` is read from `CONFUSIONFLOW_LOGDIR`.
+    `config` updates the app config, e.g. with the `CACHE_DIR` shared by the
+    worker processes of a server or the number of `CPU_WORKERS`.
+    """
     app = Flask(__name__)
+    app.config.update(config or {})
 
-    if logdir is None:
+    if logdir is None and not logdirs and rootdir is None:
         logdir = get_logdir_from_env()
 
     static_file_path = os.path.join(
         os.path.dirname(os.path.realpath(confusionflow.__file__)), "static"
     )
 
+    # setup in-memory cache for files served by web, each logdir has its own cache
+    app.config.setdefault("FILE_CACHE_SIZE", 256 * 1024 * 1024)
+    app.config.setdefault("LOGDIR_CACHE_SIZE", 64 * 1024 * 1024)
+    app.config["FILE_CACHE"] = FileCache(app.config["FILE_CACHE_SIZE"])
+
+    # setup on-disk cache for the responses of all logdirs, which is shared by
+    # all worker processes of a server
+    app.config.setdefault("CACHE_DIR", None)
+    app.config.setdefault("DISK_CACHE_SIZE", 1024 * 1024 * 1024)
+    diskcache = None
+    if app.config["CACHE_DIR"] is not None:
+        diskcache = DiskCache(app.config["CACHE_DIR"], app.config["DISK_CACHE_SIZE"])
+
+    # setup process pool serializing foldlog data outside of the server process
+    app.config.setdefault("CPU_WORKERS", 0)
+    if app.config["CPU_WORKERS"] > 0:
+        app.config["CPU_POOL"] = CPUPool(app.config["CPU_WORKERS"])
+
+    # compress responses that were not compressed when served
+    app.after_request(compress_response)
+
     # setup api
-    app.config["LOGDIR"] = check_folderpath(logdir)
+    registry = LogDirRegistry(app.config["LOGDIR_CACHE_SIZE"], rootdir, diskcache)
+    if logdir is not None:
+        registry.add(os.path.basename(os.path.realpath(logdir)), logdir, default=True)
+    for name, path in sorted((logdirs or {}).items()):
+        registry.add(name, path, default=logdir is None and len(logdirs) == 1)
+    app.config["LOGDIRS"] = registry
     app.register_blueprint(api.bp, url_prefix="/api")
+    app.register_blueprint(api.bp, url_prefix="/api/<logdir>", name="api_logdir")
 
     # setup web
     # only setup web if not in development mode
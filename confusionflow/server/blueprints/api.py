@@ -2,34 +2,53 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
 import os
 
-from flask import Blueprint
+from flask import Blueprint, Response, current_app, g, jsonify, request
 
-from confusionflow.server.utils import serve_file
+from confusionflow.server.compare import (
+    ALIGNMENTS,
+    MODES,
+    compare_readers,
+    comparison_stat,
+)
+from confusionflow.server.events import (
+    FoldLogFollower,
+    RunsFollower,
+    parse_foldlogs,
+    stream_events,
+)
+from confusionflow.server.pool import compare_files, serialize_file, serialize_reader
+from confusionflow.server.reader import ENCODINGS, parse_epochId
+from confusionflow.server.runindex import SORT_KEYS, decode_cursor
+from confusionflow.server.utils import serve_file, serve_serialized
 
 
-logdir = None
+NPY_MIMETYPES = ["application/x-npy", "application/octet-stream"]
 
 bp = Blueprint("api", __name__)
 
 
-@bp.record
-def record_logdir(setup_state):
-    """Sets the logdir based on the config during Blueprint setup."""
-    global logdir
+@bp.url_value_preprocessor
+def pull_logdir_name(endpoint, values):
+    """Removes the name of the log directory from the URL values of routes
+    registered under `/api/<logdir>`."""
+    g.logdir_name = values.pop("logdir", None) if values else None
 
-    config = setup_state.app.config
-    logdir = config["LOGDIR"]
+
+@bp.before_request
+def load_logdir():
+    """Looks up the log directory of the request in the LOGDIRS registry."""
+    g.logdir = current_app.config["LOGDIRS"].get(g.logdir_name)
+    if g.logdir is None and request.endpoint != "api.get_logdirs":
+        return "logdir not found", 404
 
 
-# TODO update to ETag
 @bp.after_request
 def set_response_headers(response):
-    """Disables caching."""
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate, max-age=0"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
+    """Requires clients to revalidate cached responses via their ETag."""
+    response.headers["Cache-Control"] = "no-cache"
     return response
 
 
@@ -38,50 +57,504 @@ def api_hello():
     return "Welcome to ConfusionFlow API"
 
 
+@bp.route("/cache")
+def get_cache_stats():
+    """Returns the hit and miss counters of the file cache."""
+    return jsonify(g.logdir.cache.stats())
+
+
+@bp.route("/logdirs")
+def get_logdirs():
+    """Returns the names of all log directories served under `/api/<logdir>`."""
+    registry = current_app.config["LOGDIRS"]
+    default = registry.get()
+    logdirs = [
+        {"name": name, "default": default is not None and name == default.name}
+        for name in registry.names()
+    ]
+    return jsonify(logdirs)
+
+
+@bp.route("/events")
+def get_events():
+    """Streams the changes of the log directory as Server-Sent Events.
+
+    A `runs` event with the updated and removed runs is sent whenever the run
+    index changes. For every foldlog in the comma-separated query parameter
+    `foldlogs` an `epochs` event with the new epochs is sent as soon as they are
+    written. With `<foldlogId>:<epochId>` the epochs after `epochId` written
+    before connecting are sent as well.
+    """
+    try:
+        foldlogs = parse_foldlogs(request.args.get("foldlogs", ""))
+    except ValueError:
+        return "invalid foldlogs", 400
+
+    followers = [RunsFollower(g.logdir)]
+    for foldlogId, after in foldlogs:
+        followers.append(FoldLogFollower(g.logdir, foldlogId, after))
+
+    response = Response(
+        stream_events(g.logdir, followers), mimetype="text/event-stream"
+    )
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 @bp.route("/runs")
 def get_runs():
-    """Returns a list of all available runs as a JSON file."""
-    runfolder = os.path.join(logdir, "runs")
-    return serve_file(runfolder, "index.json", "Could not load runs.")
+    """Returns a list of all available runs as a JSON file.
+
+    With query parameters a page of the runs is returned instead, as
+    `{"total": ..., "runs": [...], "next": <cursor>}`:
+
+    - `runId` (shell-style pattern), `dataset`, `trainfoldId` and
+      `hyperparam.<name>=<value>` filter the runs,
+    - `sort` is `runId`, `exported` or `accuracy` (the accuracy at the last
+      epoch of fold `fold`, the train fold by default), `-` sorts descending,
+    - `limit` restricts the page size, `cursor` continues after the previous
+      page and `offset` skips runs,
+    - `fields` is a comma-separated list of the run fields to return.
+    """
+    if not request.args:
+        return g.logdir.serve_document("runs", "index", "Could not load runs.")
+
+    try:
+        query, fields = get_run_query()
+        page = g.logdir.runindex.query(**query)
+    except ValueError as e:
+        return str(e), 400
+
+    if fields is not None:
+        page["runs"] = [
+            dict((key, run[key]) for key in fields if key in run)
+            for run in page["runs"]
+        ]
+    return jsonify(page)
+
+
+def get_run_query():
+    """Parses the query parameters of a paginated run listing."""
+    query = dict()
+    for key in ["runId", "dataset", "trainfoldId", "cursor"]:
+        if key in request.args:
+            query[key] = request.args[key]
+    if "cursor" in query:
+        query["cursor"] = decode_cursor(query["cursor"])
+    if "fold" in request.args:
+        query["foldId"] = request.args["fold"]
+
+    hyperparam = dict()
+    for key, value in request.args.items():
+        if key.startswith("hyperparam."):
+            hyperparam[key.partition(".")[2]] = value
+    query["hyperparam"] = hyperparam
+
+    sort = request.args.get("sort", "runId")
+    query["reverse"] = sort.startswith("-")
+    query["sort"] = sort.lstrip("-")
+    if query["sort"] not in SORT_KEYS:
+        raise ValueError("sort must be one of {}".format(", ".join(SORT_KEYS)))
+
+    for key in ["offset", "limit"]:
+        if key in request.args:
+            query[key] = int(request.args[key])
+            if query[key] < 0:
+                raise ValueError("{} must not be negative".format(key))
+
+    fields = None
+    if "fields" in request.args:
+        fields = request.args["fields"].split(",")
+
+    return query, fields
 
 
 @bp.route("/run/<runId>")
 def get_run_by_id(runId):
     """Returns the run <runId> as a JSON file."""
-    runfolder = os.path.join(logdir, "runs")
-    filename = runId + ".json"
-    return serve_file(runfolder, filename, "runId not found")
+    return g.logdir.serve_document("runs", runId, "runId not found")
 
 
 @bp.route("/foldlog/<foldlogId>")
 def get_foldlog_by_id(foldlogId):
     """Returns the foldlog <foldlogId> as a JSON file."""
-    foldlogfolder = os.path.join(logdir, "foldlogs")
-    filename = foldlogId + ".json"
-    return serve_file(foldlogfolder, filename, "foldlogId not found")
+    return g.logdir.serve_document("foldlogs", foldlogId, "foldlogId not found")
 
 
 @bp.route("/foldlog/<foldlogId>/data")
 def get_foldlogdata_by_id(foldlogId):
-    """Returns the data for foldlog <foldlogId> as a JSON file."""
-    foldlogdatafolder = os.path.join(logdir, "foldlogdata")
-    filename = foldlogId + "_data.json"
-    return serve_file(foldlogdatafolder, filename, "data for foldlogId not found")
+    """Returns the data for foldlog <foldlogId> as a JSON file.
+
+    The confusion matrices are returned as `.npy` encoded array instead if
+    requested via `?format=npy` or the `Accept` header.
+
+    The epochs can be restricted with the query parameters `epoch` (a single
+    epochId or a comma-separated list), `start` and `stop` (inclusive epochId
+    range) and `stride` (every n-th of the selected epochs).
+    JSON data is returned as stored unless `encoding` is `dense` or `sparse`.
+
+    With `resolution` at most that many epochs are returned, longer histories
+    are averaged over windows of epochs (see :py:func:`serve_lod`).
+    """
+    errormsg = "data for foldlogId not found"
+    source = g.logdir.find_foldlogdata(foldlogId)
+    if source is None:
+        return errormsg
+
+    try:
+        selection = get_epoch_selection()
+    except ValueError:
+        return "invalid epoch selection", 400
+
+    requested_format = get_requested_format()
+    encoding = request.args.get("encoding")
+    if encoding is not None and encoding not in ENCODINGS:
+        return "encoding `{}` is not supported".format(encoding), 400
+
+    if (
+        not selection
+        and encoding is None
+        and "resolution" not in request.args
+        and source.endswith("." + requested_format)
+        and os.path.isfile(source)
+    ):
+        foldername, filename = os.path.split(source)
+        return serve_file(foldername, filename, errormsg, cache=g.logdir.cache)
+
+    variant = requested_format
+    if selection:
+        variant += ":" + format_selection(selection)
+
+    options = dict()
+    if requested_format == "json":
+        variant += ":" + (encoding or "stored")
+        options["encoding"] = encoding
+
+    if "resolution" in request.args:
+        if requested_format == "json":
+
+            def serialize_level(pyramid, level, selection):
+                data = pyramid.asdict(level, **selection)
+                return json.dumps(data), "application/json"
+
+        else:
+
+            def serialize_level(pyramid, level, selection):
+                return pyramid.tobytes(level, **selection), NPY_MIMETYPES[0]
+
+        return serve_lod(
+            foldlogId,
+            source,
+            variant,
+            (requested_format, options),
+            serialize_level,
+            selection,
+        )
+
+    return serve_foldlogdata(source, variant, requested_format, options, selection)
+
+
+@bp.route("/foldlog/<foldlogId>/data/header")
+def get_foldlogdata_header_by_id(foldlogId):
+    """Returns the epochIds and array shape for the data of foldlog <foldlogId>.
+
+    With `resolution` the epochIds and windows of the matching level of detail
+    are returned.
+    """
+    source = g.logdir.find_foldlogdata(foldlogId)
+    if source is None:
+        return "data for foldlogId not found"
+
+    if "resolution" in request.args:
+        try:
+            selection = get_epoch_selection()
+        except ValueError:
+            return "invalid epoch selection", 400
+
+        def serialize_level(pyramid, level, selection):
+            return json.dumps(pyramid.header(level, **selection)), "application/json"
+
+        return serve_lod(
+            foldlogId, source, "header", ("header", None), serialize_level, selection
+        )
+
+    return serve_foldlogdata(source, "header", "header")
+
+
+@bp.route("/foldlog/<foldlogId>/metrics")
+def get_foldlog_metrics_by_id(foldlogId):
+    """Returns the accuracy and per-class precision, recall and F1 score of
+    foldlog <foldlogId> for every epoch as a JSON file.
+
+    The metrics are cached in `<foldlogId>_metrics.json` next to the foldlog
+    data and recomputed once the data changes. If the file cannot be written
+    the metrics are only cached in memory.
+    """
+    errormsg = "data for foldlogId not found"
+    source = g.logdir.find_foldlogdata(foldlogId)
+    if source is None:
+        return errormsg
+
+    metricsfile = g.logdir.get_metrics_file(foldlogId, source)
+    if metricsfile is None:
+        return serve_foldlogdata(source, "metrics", "metrics")
+
+    foldername, filename = metricsfile
+    return serve_file(foldername, filename, errormsg, cache=g.logdir.cache)
+
+
+@bp.route("/foldlog/<foldlogId>/subset")
+def get_foldlog_subset_by_id(foldlogId):
+    """Returns the confusion matrices of foldlog <foldlogId> restricted to the
+    classes in the query parameter `classes` as a JSON file.
+
+    `classes` is a comma-separated list of class names from the dataset config
+    or class indices. All other classes are aggregated in an additional class
+    `other`. The epochs can be selected as for the foldlog data.
+    """
+    errormsg = "data for foldlogId not found"
+    source = g.logdir.find_foldlogdata(foldlogId)
+    if source is None:
+        return errormsg
+
+    try:
+        selection = get_epoch_selection()
+        indices, classnames = get_class_selection(foldlogId, source)
+    except ValueError:
+        return "invalid class or epoch selection", 400
+
+    variant = "subset:classes={}".format(",".join(map(str, indices)))
+    if selection:
+        variant += "&" + format_selection(selection)
+
+    options = {"indices": indices, "classnames": classnames}
+    return serve_foldlogdata(source, variant, "subset", options, selection)
+
+
+@bp.route("/compare")
+def get_comparison():
+    """Compares the confusion matrices of the foldlogs in the comma-separated
+    query parameter `foldlogIds` with the first one as a JSON file.
+
+    `align` selects the compared epochs: `same` (the epochs logged by all
+    foldlogs, which can be restricted as for the foldlog data), `last` or
+    `best` (the epoch with the highest accuracy of each foldlog).
+    `mode` is `diff` for difference or `ratio` for ratio matrices. The
+    differences of accuracy and per-class precision, recall and F1 score are
+    returned in both modes.
+    """
+    foldlogIds = [f for f in request.args.get("foldlogIds", "").split(",") if f]
+    align = request.args.get("align", "same")
+    mode = request.args.get("mode", "diff")
+    if len(foldlogIds) < 2:
+        return "at least two foldlogIds are required", 400
+    if align not in ALIGNMENTS:
+        return "align must be one of {}".format(", ".join(ALIGNMENTS)), 400
+    if mode not in MODES:
+        return "mode must be one of {}".format(", ".join(MODES)), 400
+
+    sources = []
+    for foldlogId in foldlogIds:
+        source = g.logdir.find_foldlogdata(foldlogId)
+        if source is None:
+            return "data for foldlogId `{}` not found".format(foldlogId)
+        sources.append(source)
+
+    try:
+        selection = get_epoch_selection()
+    except ValueError:
+        return "invalid epoch selection", 400
+
+    variant = "compare:align={}&mode={}".format(align, mode)
+    if selection:
+        variant += "&" + format_selection(selection)
+
+    pool = current_app.config.get("CPU_POOL")
+    filepaths = [g.logdir.get_filepath(source) for source in sources]
+
+    def serialize_comparison(key):
+        if pool is not None and None not in filepaths:
+            return pool.apply(compare_files, filepaths, align, mode, selection)
+
+        readers = [g.logdir.open_foldlogdata(source) for source in sources]
+        comparison = compare_readers(readers, align, mode, selection)
+        return json.dumps(comparison), "application/json"
+
+    try:
+        return serve_serialized(
+            "compare:" + ",".join(sources),
+            variant,
+            serialize_comparison,
+            cache=g.logdir.cache,
+            filestat=comparison_stat([g.logdir.stat(source) for source in sources]),
+        )
+    except ValueError as e:
+        return str(e), 400
+
+
+def get_class_selection(foldlogId, source):
+    """Parses the `classes` query parameter into class indices and names.
+
+    Without a dataset config the indices are checked against the number of
+    classes of the foldlog data in `source`.
+    """
+    classes = load_classes(foldlogId)
+    if classes:
+        numclass = len(classes)
+    else:
+        numclass = g.logdir.open_foldlogdata(source).numclass
+
+    indices = []
+    for token in request.args.get("classes", "").split(","):
+        if token in classes:
+            index = classes.index(token)
+        elif token.isdigit() and int(token) < numclass:
+            index = int(token)
+        else:
+            raise ValueError("unknown class `{}`".format(token))
+
+        if index not in indices:
+            indices.append(index)
+
+    classnames = [classes[i] if classes else str(i) for i in indices]
+    return indices, classnames
+
+
+def load_classes(foldlogId):
+    """Returns the class names of the dataset of foldlog <foldlogId> or an
+    empty list if the dataset config is not available."""
+    foldlog = g.logdir.read_cached_document("foldlogs", foldlogId)
+    datasets = g.logdir.read_cached_document("datasets", "index")
+    if foldlog is None or datasets is None:
+        return []
+
+    foldId = foldlog["foldId"]
+    for dataset in datasets:
+        if any(fold["foldId"] == foldId for fold in dataset["folds"]):
+            return dataset["classes"]
+
+    return []
+
+
+def serve_foldlogdata(source, variant, name, options=None, selection=None):
+    """Serves the response of the serializer `name` (see
+    :py:data:`confusionflow.server.pool.SERIALIZERS`) for the selected epochs
+    of the foldlog data in `source`, cached until the data changes."""
+    return serve_serialized(
+        source,
+        variant,
+        select_serialized(name, options, selection),
+        cache=g.logdir.cache,
+        filestat=g.logdir.stat(source),
+    )
+
+
+def serve_lod(foldlogId, source, variant, serializer, serialize_level, selection):
+    """Serves the foldlog data at the level of detail matching the query
+    parameter `resolution`.
+
+    The most detailed level of the foldlog's Pyramid with at most `resolution`
+    epochs or windows between `start` and `stop` is selected. Level 0 is
+    served by the serializer `(name, options)` like the foldlog data, the mean
+    confusion matrices of every window of the other levels with
+    `serialize_level(pyramid, level, selection)`.
+    """
+    try:
+        resolution = int(request.args["resolution"])
+    except ValueError:
+        return "resolution must be an integer", 400
+    if resolution < 1:
+        return "resolution must be positive", 400
+    if set(selection) - {"start", "stop"}:
+        return "resolution can only be combined with start and stop", 400
+
+    def serialize_lod(source):
+        pyramid = g.logdir.get_pyramid(foldlogId, source)
+        level = pyramid.select_level(resolution, **selection)
+        if level == 0:
+            return select_serialized(*serializer, selection=selection)(source)
+        return serialize_level(pyramid, level, selection)
+
+    return serve_serialized(
+        source,
+        "{}:resolution={}".format(variant, resolution),
+        serialize_lod,
+        cache=g.logdir.cache,
+        filestat=g.logdir.stat(source),
+    )
+
+
+def select_serialized(name, options=None, selection=None):
+    """Returns a function serializing the selected epochs of a foldlog data file.
+
+    The serialization runs in the CPU pool of the server, if any, unless the
+    data is not stored in a file.
+    """
+    pool = current_app.config.get("CPU_POOL")
+
+    def serialize_selection(source):
+        filepath = g.logdir.get_filepath(source)
+        if pool is not None and filepath is not None:
+            return pool.apply(serialize_file, filepath, name, options, selection)
+
+        reader = g.logdir.open_foldlogdata(source)
+        return serialize_reader(reader, name, options, selection)
+
+    return serialize_selection
+
+
+def get_epoch_selection():
+    """Parses the `epoch`, `start`, `stop` and `stride` query parameters."""
+    selection = dict()
+    if "epoch" in request.args:
+        selection["epochIds"] = [
+            parse_epochId(e) for e in request.args["epoch"].split(",")
+        ]
+
+    for key in ["start", "stop"]:
+        if key in request.args:
+            selection[key] = parse_epochId(request.args[key])
+    if "stride" in request.args:
+        selection["stride"] = int(request.args["stride"])
+
+    if selection.get("stride", 1) < 1:
+        raise ValueError("stride must be positive")
+
+    return selection
+
+
+def format_selection(selection):
+    """Returns a canonical string representation of an epoch selection."""
+    items = []
+    for key, value in sorted(selection.items()):
+        if isinstance(value, list):
+            value = ",".join(map(str, value))
+        items.append("{}={}".format(key, value))
+
+    return "&".join(items)
+
+
+def get_requested_format():
+    """Returns `npy` if the client asked for binary foldlog data, else `json`."""
+    if "format" in request.args:
+        return "npy" if request.args["format"] == "npy" else "json"
+
+    best_match = request.accept_mimetypes.best_match(
+        ["application/json"] + NPY_MIMETYPES
+    )
+    return "npy" if best_match in NPY_MIMETYPES else "json"
 
 
 @bp.route("/datasets")
 def get_datasets():
     """Returns a list of all avaliable datasets as a JSON file."""
-    datasetsfolder = os.path.join(logdir, "datasets")
-    return serve_file(datasetsfolder, "index.json", "Could not load datasets.")
+    return g.logdir.serve_document("datasets", "index", "Could not load datasets.")
 
 
 @bp.route("/dataset/<datasetId>")
 def get_dataset_by_id(datasetId):
     """Returns the dataset <datasetId> as a JSON file."""
-    datasetsfolder = os.path.join(logdir, "datasets")
-    filename = datasetId + ".json"
-    return serve_file(datasetsfolder, filename, "datasetId not found.")
+    return g.logdir.serve_document("datasets", datasetId, "datasetId not found.")
 
 
 @bp.route("/views")
@@ -2,32 +2,40 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from flask import Blueprint
+from flask import Blueprint, current_app, request
 
 from confusionflow.server.utils import serve_file
 
 
-static_file_path = None
+STATIC_MAX_AGE = 7 * 24 * 60 * 60
 
 bp = Blueprint("static", __name__)
 
 
-@bp.record
-def record_satic_file_path(setup_state):
-    """Sets the static_file_path based on the config during Blueprint setup."""
-    global static_file_path
-
-    config = setup_state.app.config
-    static_file_path = config["STATIC_FILE_PATH"]
+@bp.after_request
+def set_response_headers(response):
+    """Lets clients cache the UI assets for a week, 'index.html' is always
+    revalidated via its ETag so that a new UI version is picked up."""
+    if request.endpoint == "static.index" or request.path.endswith("index.html"):
+        response.headers["Cache-Control"] = "no-cache"
+    else:
+        response.headers["Cache-Control"] = "public, max-age={}".format(STATIC_MAX_AGE)
+    return response
 
 
 @bp.route("/")
 def index():
     """Returns 'index.html' of 'ui' component"""
-    return serve_file(static_file_path, "index.html", "")
+    config = current_app.config
+    return serve_file(
+        config["STATIC_FILE_PATH"], "index.html", "", cache=config["FILE_CACHE"]
+    )
 
 
 @bp.route("/<path:filename>")
 def serve_static(filename):
     """Serves files from 'static_file_folder'."""
-    return serve_file(static_file_path, filename, "")
+    config = current_app.config
+    return serve_file(
+        config["STATIC_FILE_PATH"], filename, "", cache=config["FILE_CACHE"]
+    )
@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import mimetypes
+import threading
+
+CacheEntry = collections.namedtuple(
+    "CacheEntry", ["data", "mimetype", "mtime", "size", "inode"]
+)
+
+
+class FileCache:
+    """
+    A FileCache keeps the contents of recently served files in memory.
+
+    Entries are keyed by path and invalidated as soon as the mtime or size of
+    the file changes. The least recently used entries are evicted once the
+    cached contents exceed `maxsize` bytes, files larger than `maxitemsize`
+    bytes are never cached.
+    Serialized responses missing in memory are looked up in the DiskCache
+    `diskcache` shared by all worker processes, if any.
+    """
+
+    def __init__(self, maxsize, maxitemsize=None, diskcache=None):
+        self.maxsize = maxsize
+        self.maxitemsize = maxsize // 4 if maxitemsize is None else maxitemsize
+        self.diskcache = diskcache
+        self.currsize = 0
+        self.hits = 0
+        self.diskhits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def accepts(self, size):
+        return size <= self.maxitemsize
+
+    def get(self, filepath, stat, variant=None, serialize=None):
+        """Returns the CacheEntry for `filepath`, `stat` is the current
+        `os.stat` result of the file.
+
+        By default the entry holds the file contents. A `serialize` function
+        returning `(data, mimetype)` for `filepath` can be supplied to cache a
+        pre-serialized response derived from the file under the key `variant`.
+        """
+        key = (filepath, variant)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and is_current(entry, stat):
+                self.entries[key] = self.entries.pop(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        if serialize is None:
+            data, mimetype = read_file(filepath)
+        else:
+            data, mimetype = self.serialize(filepath, stat, variant, serialize)
+        entry = CacheEntry(data, mimetype, stat.st_mtime, stat.st_size, stat.st_ino)
+
+        with self.lock:
+            self.discard(key)
+            if self.accepts(len(data)):
+                self.entries[key] = entry
+                self.currsize += len(entry.data)
+            while self.currsize > self.maxsize:
+                _, evicted = self.entries.popitem(last=False)
+                self.currsize -= len(evicted.data)
+
+        return entry
+
+    def serialize(self, filepath, stat, variant, serialize):
+        """Returns `serialize(filepath)` from the DiskCache or stores it there."""
+        if self.diskcache is None:
+            return serialize(filepath)
+
+        cached = self.diskcache.get(filepath, stat, variant)
+        if cached is not None:
+            with self.lock:
+                self.diskhits += 1
+            return cached
+
+        data, mimetype = serialize(filepath)
+        self.diskcache.put(filepath, stat, variant, data, mimetype)
+        return data, mimetype
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.currsize -= len(entry.data)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "diskhits": self.diskhits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "currsize": self.currsize,
+                "maxsize": self.maxsize,
+            }
+
+
+def read_file(filepath):
+    with open(filepath, "rb") as f:
+        data = f.read()
+    mimetype = mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+    return data, mimetype
+
+
+def is_current(entry, stat):
+    return (
+        entry.mtime == stat.st_mtime
+        and entry.size == stat.st_size
+        and entry.inode == stat.st_ino
+    )
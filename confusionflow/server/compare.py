@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+
+import numpy as np
+
+from confusionflow.confmat import compare_confmats, compute_metrics
+from confusionflow.server.logdir import StoreStat
+
+ALIGNMENTS = ("same", "last", "best")
+MODES = ("diff", "ratio")
+
+
+def align_readers(readers, align="same", selection=None):
+    """Restricts the readers of several foldlogs to aligned epochs.
+
+    With `same` all readers keep the epochs logged by every foldlog, optionally
+    restricted further by an epoch `selection`. With `last` each reader keeps
+    its last epoch and with `best` the epoch with the highest accuracy.
+    """
+    for reader in readers:
+        if not reader.numepochs:
+            raise ValueError("foldlog `{}` has no epochs".format(reader.foldlogId))
+
+    if align == "same":
+        common = set(readers[0].epochIds)
+        for reader in readers[1:]:
+            common &= set(reader.epochIds)
+        reference = readers[0].select(epochIds=sorted(common))
+        if selection:
+            reference = reference.select(**selection)
+        if not reference.numepochs:
+            raise ValueError("the foldlogs have no common epochs")
+        return [reader.select(epochIds=reference.epochIds) for reader in readers]
+
+    aligned = []
+    for reader in readers:
+        if align == "best":
+            index = int(np.argmax(compute_metrics(reader.confmats)["accuracy"]))
+        else:
+            index = reader.numepochs - 1
+        aligned.append(reader.select(epochIds=[reader.epochIds[index]]))
+    return aligned
+
+
+def compare_readers(readers, align="same", mode="diff", selection=None):
+    """Compares the confusion matrices of the foldlogs of `readers[1:]` with
+    the first foldlog at the aligned epochs.
+
+    For every compared foldlog the difference or ratio matrices and the
+    differences of accuracy, precision, recall and F1 score are returned for
+    every aligned epoch.
+    """
+    readers = align_readers(readers, align, selection)
+    numclass = readers[0].numclass
+    if any(reader.numclass != numclass for reader in readers):
+        raise ValueError("the foldlogs have different numbers of classes")
+
+    reference, others = readers[0], readers[1:]
+    matrices, deltas = compare_confmats(
+        reference.confmats, np.stack([reader.confmats for reader in others]), mode
+    )
+
+    d = dict()
+    d["reference"] = reference.foldlogId
+    d["align"] = align
+    d["mode"] = mode
+    d["numclass"] = numclass
+    d["epochIds"] = list(reference.epochIds)
+    d["comparisons"] = []
+    for i, reader in enumerate(others):
+        comparison = dict()
+        comparison["foldlogId"] = reader.foldlogId
+        comparison["epochIds"] = list(reader.epochIds)
+        comparison["matrices"] = matrices[i].reshape(reader.numepochs, -1).tolist()
+        for name, values in deltas.items():
+            comparison[name] = values[i].tolist()
+        d["comparisons"].append(comparison)
+
+    return d
+
+
+def comparison_stat(filestats):
+    """Combines the stats of the compared foldlog data into a single stat,
+    which changes whenever one of the files changes."""
+    versions = [
+        (filestat.st_mtime, filestat.st_size, filestat.st_ino) for filestat in filestats
+    ]
+    digest = hashlib.sha1(repr(versions).encode("utf-8")).hexdigest()
+    return StoreStat(0, len(versions), int(digest[slice(None, 15)], 16))
@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+
+from confusionflow.server.utils import get_version
+from confusionflow.utils import check_folderpath, open_atomic
+
+# the cache folder is checked for entries to evict every EVICT_INTERVAL writes
+EVICT_INTERVAL = 64
+
+
+class DiskCache:
+    """
+    A DiskCache keeps serialized responses in files of a folder, which is
+    shared by all worker processes of a server.
+
+    It is the second tier of the in-memory FileCache: a response serialized by
+    one worker is read from disk by the others instead of being serialized
+    again. Entries are keyed by path and variant and hold the mtime, size and
+    inode of the file they were derived from, so they are ignored once the file
+    changes. The least recently used entries are removed once the cached files
+    exceed `maxsize` bytes.
+    """
+
+    def __init__(self, folder, maxsize):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.folder = check_folderpath(folder)
+        self.maxsize = maxsize
+        self.writes = 0
+
+    def get(self, filepath, stat, variant):
+        """Returns the cached `(data, mimetype)` of `filepath` and `variant` or
+        `None` if not cached for the current `stat` of the file."""
+        entrypath = self.get_entrypath(filepath, variant)
+        try:
+            with open(entrypath, "rb") as f:
+                header = json.loads(f.readline().decode("utf-8"))
+                if header["version"] != get_version(stat):
+                    return None
+                data = f.read()
+            os.utime(entrypath, None)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+        if header.get("text"):
+            data = data.decode("utf-8")
+        return data, header["mimetype"]
+
+    def put(self, filepath, stat, variant, data, mimetype):
+        header = {
+            "version": get_version(stat),
+            "mimetype": mimetype,
+            "text": not isinstance(data, bytes),
+        }
+        if header["text"]:
+            data = data.encode("utf-8")
+
+        try:
+            with open_atomic(self.get_entrypath(filepath, variant), "wb") as f:
+                f.write(json.dumps(header).encode("utf-8") + b"\n")
+                f.write(data)
+        except (IOError, OSError):
+            # the disk is full or the folder was removed, the response is only
+            # cached in memory
+            return
+
+        self.writes += 1
+        if self.writes % EVICT_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cached files take
+        at most `maxsize` bytes."""
+        entries = []
+        for filename in os.listdir(self.folder):
+            if not filename.endswith(".cache"):
+                continue
+            try:
+                filestat = os.stat(os.path.join(self.folder, filename))
+            except OSError:
+                continue
+            entries.append((filestat.st_mtime, filestat.st_size, filename))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(os.path.join(self.folder, filename))
+            except OSError:
+                pass
+            total -= size
+
+    def get_entrypath(self, filepath, variant):
+        key = json.dumps([filepath, variant]).encode("utf-8")
+        return os.path.join(self.folder, hashlib.sha1(key).hexdigest() + ".cache")
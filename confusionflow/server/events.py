@@ -0,0 +1,158 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+from confusionflow.server.reader import parse_epochId, read_jsonl_epochs
+
+HEARTBEAT_INTERVAL = 15
+
+
+class RunsFollower:
+    """
+    A RunsFollower sends a `runs` event with the updated and removed runs
+    whenever the run index of a log directory changes.
+    """
+
+    def __init__(self, logdir):
+        self.logdir = logdir
+        self.runs = dict()
+
+    def start(self):
+        self.runs = self.read_runs()
+        return []
+
+    def watches(self, path):
+        return path == "runs/index.json"
+
+    def poll(self):
+        runs = self.read_runs()
+        updated = [run for runId, run in runs.items() if self.runs.get(runId) != run]
+        removed = [runId for runId in self.runs if runId not in runs]
+        self.runs = runs
+
+        if updated or removed:
+            yield "runs", {"updated": updated, "removed": removed}
+
+    def read_runs(self):
+        runs = self.logdir.read_document("runs", "index") or []
+        return dict((run["runId"], run) for run in runs)
+
+
+class FoldLogFollower:
+    """
+    A FoldLogFollower sends an `epochs` event with the epochs of a foldlog that
+    were written since the last event.
+
+    Epochs streamed to a `.jsonl` file are read incrementally from the last
+    read position, exported foldlog data is read again once it changes.
+    Only epochs after `after` are sent, which defaults to the last epoch that
+    was written when the client connected.
+    """
+
+    def __init__(self, logdir, foldlogId, after=None):
+        self.logdir = logdir
+        self.foldlogId = foldlogId
+        self.after = after
+        self.filepath = None
+        self.inode = None
+        self.offset = 0
+
+    def start(self):
+        """Returns the events for the epochs written before the client
+        connected, which are only sent if `after` is given."""
+        backlog = self.after is not None
+        events = list(self.poll())
+        return events if backlog else []
+
+    def watches(self, path):
+        return path.startswith("foldlogdata/" + self.foldlogId + "_data.")
+
+    def poll(self):
+        source = self.logdir.find_foldlogdata(self.foldlogId)
+        if source is None:
+            return
+
+        try:
+            epochdata = self.read_epochs(source)
+        except (IOError, OSError, ValueError):
+            # the file was replaced while reading, it is read again on the
+            # next change
+            return
+
+        if self.after is not None:
+            epochdata = [entry for entry in epochdata if entry["epochId"] > self.after]
+        if not epochdata:
+            return
+
+        self.after = epochdata[-1]["epochId"]
+        yield "epochs", {"foldlogId": self.foldlogId, "epochdata": epochdata}
+
+    def read_epochs(self, source):
+        if not source.endswith(".jsonl"):
+            self.filepath = source
+            reader = self.logdir.open_foldlogdata(source, self.after)
+            return reader.asdict()["epochdata"]
+
+        filepath = source
+        filestat = os.stat(filepath)
+        if (
+            filepath != self.filepath
+            or filestat.st_ino != self.inode
+            or filestat.st_size < self.offset
+        ):
+            self.filepath, self.inode, self.offset = filepath, filestat.st_ino, 0
+
+        epochdata, self.offset = read_jsonl_epochs(filepath, self.offset)
+        return epochdata
+
+
+def parse_foldlogs(value):
+    """Parses the comma-separated `<foldlogId>[:<epochId>]` list of foldlogs a
+    client subscribes to."""
+    foldlogs = []
+    for token in value.split(","):
+        if not token:
+            continue
+        foldlogId, separator, after = token.rpartition(":")
+        if not separator:
+            foldlogs.append((token, None))
+        else:
+            foldlogs.append((foldlogId, parse_epochId(after)))
+
+    return foldlogs
+
+
+def stream_events(logdir, followers, heartbeat=HEARTBEAT_INTERVAL):
+    """Yields the changes of `logdir` tracked by `followers` as Server-Sent
+    Events until the client disconnects.
+
+    A comment is sent every `heartbeat` seconds without changes, so that
+    proxies keep the connection open.
+    """
+    watcher = logdir.get_watcher()
+    generation = watcher.subscribe()
+    try:
+        yield "retry: 5000\n\n"
+        for follower in followers:
+            for name, data in follower.start():
+                yield format_event(name, data)
+
+        while True:
+            generation, changed = watcher.wait(generation, heartbeat)
+            if changed is not None and not changed:
+                yield ": heartbeat\n\n"
+                continue
+
+            for follower in followers:
+                if changed is None or any(follower.watches(p) for p in changed):
+                    for name, data in follower.poll():
+                        yield format_event(name, data)
+    finally:
+        watcher.unsubscribe()
+
+
+def format_event(name, data):
+    return "event: {}\ndata: {}\n\n".format(name, json.dumps(data))
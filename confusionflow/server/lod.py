@@ -0,0 +1,221 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import json
+
+import numpy as np
+
+from confusionflow.confmat import build_pyramid, build_sparse_pyramid, to_coo
+from confusionflow.server.reader import is_dense
+from confusionflow.utils import open_atomic
+
+LOD_FACTOR = 4
+LOD_DECIMALS = 3
+# bytes of dense confusion matrices that are aggregated at once
+LOD_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+class Pyramid:
+    """
+    A Pyramid holds the confusion matrices of a foldlog at several levels of
+    detail for timelines that show more epochs than they have pixels.
+
+    Level 0 is the foldlog data itself, level k averages the confusion matrices
+    over windows of `factor**k` consecutive epochs. The pyramid is stored as
+    `<foldlogId>_lod.npz` next to the foldlog data.
+
+    Sparse foldlog data gives a sparse pyramid, whose levels hold only the
+    non-zero cells of the summed confusion matrices, see
+    :py:func:`build_sparse_pyramid`.
+    """
+
+    def __init__(
+        self,
+        foldlogId,
+        epochIds,
+        levels,
+        numclass,
+        factor=LOD_FACTOR,
+        sparse=False,
+        source=None,
+    ):
+        self.foldlogId = foldlogId
+        self.epochIds = epochIds
+        self.levels = levels
+        self.numclass = numclass
+        self.factor = factor
+        self.sparse = sparse
+        # version of the foldlog data the pyramid was built from
+        self.source = source
+
+    @classmethod
+    def from_reader(cls, reader, factor=LOD_FACTOR, source=None):
+        """Builds the pyramid without densifying sparse data, dense data is
+        aggregated in chunks of at most `LOD_CHUNK_BYTES`."""
+        numclass = reader.numclass
+        sparse = not is_dense(reader)
+        if sparse:
+            epochs, cells, values = to_coo(reader.epochdata)
+            levels = build_sparse_pyramid(
+                epochs, cells, values, reader.numepochs, numclass, factor
+            )
+        else:
+            chunksize = LOD_CHUNK_BYTES // max(8 * numclass * numclass, 1)
+            chunksize = max(chunksize // factor, 1) * factor
+            levels = build_pyramid(reader.iter_confmats(chunksize), factor)
+        return cls(
+            reader.foldlogId,
+            list(reader.epochIds),
+            levels,
+            numclass,
+            factor,
+            sparse,
+            source,
+        )
+
+    @classmethod
+    def load(cls, filepath, source=None):
+        """Loads the pyramid from `filepath`, returns `None` without reading its
+        levels if `source` is given and it was built from another version of
+        the foldlog data."""
+        with np.load(filepath) as data:
+            header = json.loads(str(data["header"]))
+            if source is not None and header.get("source") != source:
+                return None
+            levels = []
+            for level in range(1, header["numlevels"] + 1):
+                if header["sparse"]:
+                    sums = tuple(
+                        data["{}_{}".format(name, level)]
+                        for name in ["windows", "cells", "values"]
+                    )
+                else:
+                    sums = data["sums_{}".format(level)]
+                levels.append((sums, data["counts_{}".format(level)]))
+        return cls(
+            header["foldlogId"],
+            header["epochIds"],
+            levels,
+            header["numclass"],
+            header["factor"],
+            header["sparse"],
+            header.get("source"),
+        )
+
+    def save(self, filepath):
+        header = {
+            "foldlogId": self.foldlogId,
+            "epochIds": self.epochIds,
+            "numclass": self.numclass,
+            "factor": self.factor,
+            "sparse": self.sparse,
+            "source": self.source,
+            "numlevels": len(self.levels),
+        }
+        arrays = dict(header=np.array(json.dumps(header)))
+        for level, (sums, counts) in enumerate(self.levels, 1):
+            if self.sparse:
+                for name, array in zip(["windows", "cells", "values"], sums):
+                    arrays["{}_{}".format(name, level)] = array
+            else:
+                arrays["sums_{}".format(level)] = sums
+            arrays["counts_{}".format(level)] = counts
+
+        with open_atomic(filepath, "wb") as f:
+            np.savez(f, **arrays)
+
+    @property
+    def numepochs(self):
+        return len(self.epochIds)
+
+    def get_windows(self, level, start=None, stop=None):
+        """Returns the positions of the first and last epoch of the windows of
+        `level` that overlap the epochIds `start` to `stop`."""
+        size = self.factor**level
+        firsts = np.arange(0, self.numepochs, size)
+        lasts = np.minimum(firsts + size, self.numepochs) - 1
+
+        epochIds = np.asarray(self.epochIds)
+        mask = np.ones(len(firsts), dtype=bool)
+        if start is not None:
+            mask &= epochIds[lasts] >= start
+        if stop is not None:
+            mask &= epochIds[firsts] <= stop
+        return firsts[mask], lasts[mask], np.flatnonzero(mask)
+
+    def select_level(self, resolution, start=None, stop=None):
+        """Returns the most detailed level with at most `resolution` windows
+        between the epochIds `start` and `stop`."""
+        for level in range(len(self.levels) + 1):
+            if len(self.get_windows(level, start, stop)[0]) <= resolution:
+                return level
+        return len(self.levels)
+
+    def means(self, level, index):
+        """Returns the dense mean confusion matrices of the windows `index`,
+        a sorted array of window positions, of `level`."""
+        sums, counts = self.levels[level - 1]
+        if self.sparse:
+            windows, cells, values = sums
+            selected = np.isin(windows, index)
+            sums = np.zeros((len(index), self.numclass**2), dtype=values.dtype)
+            position = np.searchsorted(index, windows[selected])
+            sums[position, cells[selected]] = values[selected]
+            sums = sums.reshape(-1, self.numclass, self.numclass)
+        else:
+            sums = sums[index]
+        return sums / counts[index].reshape(-1, 1, 1)
+
+    def header(self, level, start=None, stop=None):
+        """Returns the epochIds and windows of `level`, each window is given by
+        its first and last epochId and represented by its last epochId."""
+        firsts, lasts, _ = self.get_windows(level, start, stop)
+
+        d = dict()
+        d["foldlogId"] = self.foldlogId
+        d["level"] = level
+        d["window"] = self.factor**level
+        d["numepochs"] = len(firsts)
+        d["numclass"] = self.numclass
+        d["dtype"] = "float32"
+        d["epochIds"] = [self.epochIds[i] for i in lasts]
+        d["windows"] = [
+            [self.epochIds[first], self.epochIds[last]]
+            for first, last in zip(firsts, lasts)
+        ]
+
+        return d
+
+    def asdict(self, level, start=None, stop=None):
+        """Returns the mean confusion matrices of the windows of `level` in the
+        format of the foldlog data, with the window and its number of epochs
+        added to every entry."""
+        firsts, lasts, index = self.get_windows(level, start, stop)
+        means = np.round(self.means(level, index), LOD_DECIMALS)
+        sums, counts = self.levels[level - 1]
+
+        d = dict()
+        d["foldlogId"] = self.foldlogId
+        d["level"] = level
+        d["numepochs"] = len(index)
+        d["epochdata"] = [
+            {
+                "epochId": self.epochIds[last],
+                "window": [self.epochIds[first], self.epochIds[last]],
+                "count": int(count),
+                "confmat": mean.ravel().tolist(),
+            }
+            for first, last, count, mean in zip(firsts, lasts, counts[index], means)
+        ]
+
+        return d
+
+    def tobytes(self, level, start=None, stop=None):
+        """Returns the mean confusion matrices of the windows of `level`
+        encoded in the `.npy` format."""
+        index = self.get_windows(level, start, stop)[2]
+        buffer = io.BytesIO()
+        np.save(buffer, self.means(level, index).astype(np.float32))
+        return buffer.getvalue()
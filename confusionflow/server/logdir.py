@@ -0,0 +1,482 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import threading
+
+from confusionflow.server.cache import FileCache
+from confusionflow.server.lod import Pyramid
+from confusionflow.server.runindex import RunIndex
+from confusionflow.server.reader import (
+    FoldLogDataReader,
+    ReaderCache,
+    find_foldlogdata,
+    get_headerpath,
+    is_dense,
+    open_foldlogdata,
+    write_npy,
+)
+from confusionflow.server.utils import (
+    get_version,
+    lock_file,
+    serve_file,
+    serve_serialized,
+)
+from confusionflow.server.watcher import LogDirWatcher, SQLiteWatcher
+from confusionflow.sqlitestore import SQLiteStore, is_sqlite_path
+from confusionflow.utils import check_folderpath, write_json_atomic
+
+# first path segments of the api routes, a logdir with one of these names could
+# not be addressed as `/api/<name>/...`
+RESERVED_NAMES = frozenset(
+    [
+        "cache",
+        "compare",
+        "dataset",
+        "datasets",
+        "events",
+        "foldlog",
+        "logdirs",
+        "run",
+        "runs",
+        "view",
+        "views",
+    ]
+)
+
+
+class LogDir:
+    """
+    A LogDir is a log directory served by the API, it holds the file cache, the
+    indexes that are kept in memory and the watcher for the directory.
+
+    The API accesses the logs only through the methods of the LogDir, the
+    `source` of a foldlog's data is the path of its data file.
+    """
+
+    def __init__(self, name, path, cachesize, diskcache=None):
+        self.name = name
+        self.path = check_folderpath(path)
+        self.cache = FileCache(cachesize, diskcache=diskcache)
+        self.readers = ReaderCache()
+        self.mapped = dict()
+        self.metrics = dict()
+        self.runindex = RunIndex(self)
+        self.watcher = None
+
+    def folder(self, foldername):
+        return os.path.join(self.path, foldername)
+
+    def serve_document(self, foldername, documentId, errormsg):
+        """Serves `<documentId>.json` from `foldername`, e.g. `index` or a runId
+        from `runs`, returns `errormsg` if not found."""
+        return serve_file(
+            self.folder(foldername), documentId + ".json", errormsg, cache=self.cache
+        )
+
+    def read_document(self, foldername, documentId):
+        """Returns the parsed document or `None` if not found."""
+        filepath = os.path.join(self.folder(foldername), documentId + ".json")
+        try:
+            with open(filepath, "r") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def read_cached_document(self, foldername, documentId):
+        """Returns the parsed document like :py:meth:`read_document`, its JSON
+        text is kept in the file cache until the document changes."""
+        filestat = self.document_stat(foldername, documentId)
+        if filestat is None:
+            return None
+
+        filepath = os.path.join(self.folder(foldername), documentId + ".json")
+        try:
+            return json.loads(self.cache.get(filepath, filestat).data)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def document_stat(self, foldername, documentId):
+        """Returns the `os.stat` result of a document or `None` if not found."""
+        filepath = os.path.join(self.folder(foldername), documentId + ".json")
+        try:
+            return os.stat(filepath)
+        except OSError:
+            return None
+
+    def document_mtime(self, foldername, documentId):
+        filestat = self.document_stat(foldername, documentId)
+        return filestat.st_mtime if filestat is not None else None
+
+    def find_foldlogdata(self, foldlogId):
+        """Returns the source of the data of foldlog <foldlogId> or `None`."""
+        return find_foldlogdata(self.folder("foldlogdata"), foldlogId)
+
+    def stat(self, source):
+        return os.stat(source)
+
+    def open_foldlogdata(self, source, after=None):
+        """Opens the foldlog data in `source`, with `after` only the epochs after
+        epochId `after` are needed.
+
+        Binary data is memory-mapped by a reader shared between requests.
+        Exported JSON data is converted to the binary `<foldlogId>_mmap.npy`
+        once and memory-mapped as well, unless it is stored sparsely.
+        """
+        if source.endswith(".json"):
+            mappedpath = self.get_mapped_file(source)
+            reader = self.readers.get(mappedpath) if mappedpath else None
+        elif source.endswith(".npy"):
+            reader = self.readers.get(source)
+        else:
+            reader = None
+
+        if reader is None:
+            reader = open_foldlogdata(source)
+        if after is not None:
+            reader = reader.select(start=after)
+        return reader
+
+    def get_filepath(self, source):
+        """Returns the file other processes read the foldlog data in `source`
+        from, the binary copy of JSON data if there is one."""
+        if source.endswith(".json"):
+            return self.get_mapped_file(source) or source
+        return source
+
+    def get_mapped_file(self, source):
+        """Returns the path of the binary copy of the JSON foldlog data in
+        `source`, which is written once the data changes, or `None` if the data
+        is stored sparsely or the copy cannot be written."""
+        version = get_version(self.stat(source))
+        entry = self.mapped.get(source)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        foldlogId = os.path.basename(source).rpartition("_data")[0]
+        mappedpath = os.path.join(self.folder("foldlogdata"), foldlogId + "_mmap.npy")
+        try:
+            with open(get_headerpath(mappedpath), "r") as f:
+                current = json.load(f).get("source") == version
+        except (IOError, OSError, ValueError):
+            current = False
+
+        if not current:
+            mappedpath = self.write_mapped_file(source, version, mappedpath)
+        self.mapped[source] = (version, mappedpath)
+        return mappedpath
+
+    def write_mapped_file(self, source, version, mappedpath):
+        reader = open_foldlogdata(source)
+        if not reader.numepochs or not is_dense(reader):
+            return None
+        try:
+            write_npy(reader, mappedpath, source=version)
+        except (IOError, OSError):
+            # logdir is read-only, the JSON data is read on every request
+            return None
+
+        if get_version(self.stat(source)) != version:
+            # the data was replaced while it was converted
+            return None
+        return mappedpath
+
+    def get_metrics_file(self, foldlogId, source):
+        """Returns the folder and filename of the up-to-date metrics of foldlog
+        <foldlogId>, which are cached in `<foldlogId>_metrics.json` next to the
+        foldlog data, or `None` if the file cannot be written.
+
+        The file records the version of the foldlog data it was computed from
+        and is rewritten once the version differs.
+        """
+        folder = self.folder("foldlogdata")
+        filename = foldlogId + "_metrics.json"
+        metricspath = os.path.join(folder, filename)
+        version = get_version(self.stat(source))
+        if self.metrics.get(source) == version:
+            return folder, filename
+
+        try:
+            with open(metricspath, "r") as f:
+                current = json.load(f).get("source") == version
+        except (IOError, OSError, ValueError, AttributeError):
+            current = False
+
+        if not current:
+            metrics = self.open_foldlogdata(source).metrics()
+            metrics["source"] = version
+            try:
+                write_json_atomic(metricspath, metrics)
+            except (IOError, OSError):
+                # logdir is read-only, metrics are only cached in memory
+                return None
+
+        self.metrics[source] = version
+        return folder, filename
+
+    def get_pyramid(self, foldlogId, source):
+        """Returns the level-of-detail Pyramid of the data of foldlog
+        <foldlogId>, which is cached in `<foldlogId>_lod.npz` next to the
+        foldlog data and rebuilt once the data changes.
+
+        The file records the version of the foldlog data it was built from and
+        is written by a single server process under a lock, the others wait for
+        it and load it.
+        """
+        folder = self.folder("foldlogdata")
+        lodpath = os.path.join(folder, foldlogId + "_lod.npz")
+        version = get_version(self.stat(source))
+        pyramid = load_pyramid(lodpath, version)
+        if pyramid is not None:
+            return pyramid
+
+        with lock_file(os.path.join(folder, "." + foldlogId + "_lod.lock")) as locked:
+            pyramid = load_pyramid(lodpath, version)
+            if pyramid is not None:
+                return pyramid
+
+            reader = self.open_foldlogdata(source)
+            pyramid = Pyramid.from_reader(reader, source=version)
+            if locked:
+                try:
+                    pyramid.save(lodpath)
+                except (IOError, OSError):
+                    # logdir is read-only, the pyramid is rebuilt when needed
+                    pass
+        return pyramid
+
+    def get_watcher(self):
+        if self.watcher is None:
+            self.watcher = LogDirWatcher(self.path)
+        return self.watcher
+
+
+StoreStat = collections.namedtuple("StoreStat", ["st_mtime", "st_size", "st_ino"])
+
+# documents of the folder layout and the table and key they are stored with
+STORE_TABLES = {
+    "runs": ("runs", "runId"),
+    "foldlogs": ("foldlogs", "foldlogId"),
+    "datasets": ("datasets", "datasetId"),
+}
+
+
+class SQLiteLogDir(LogDir):
+    """
+    A SQLiteLogDir is a log directory stored in a single SQLite database (see
+    :py:class:`SQLiteStore`).
+
+    Documents and foldlog data are served from the database, their version in
+    the store takes the place of the file's mtime for caching and ETags.
+    The `source` of a foldlog's data is `<path>#<foldlogId>`.
+    """
+
+    def __init__(self, name, path, cachesize, diskcache=None):
+        if not os.path.isfile(path):
+            raise OSError("Error! `{}` is not a valid SQLite logdir".format(path))
+
+        self.name = name
+        self.path = os.path.realpath(path)
+        self.store = SQLiteStore(self.path, readonly=True)
+        self.cache = FileCache(cachesize, diskcache=diskcache)
+        self.runindex = RunIndex(self)
+        self.watcher = None
+
+    def serve_document(self, foldername, documentId, errormsg):
+        table, key = STORE_TABLES.get(foldername, (None, None))
+        if table is None:
+            return errormsg
+
+        filestat = self.document_stat(foldername, documentId)
+        if filestat is None and documentId != "index":
+            return errormsg
+
+        def serialize(source):
+            return self.get_document(table, key, documentId), "application/json"
+
+        source = "{}#{}/{}".format(self.path, foldername, documentId)
+        return serve_serialized(
+            source,
+            "document",
+            serialize,
+            cache=self.cache,
+            filestat=filestat or StoreStat(0, 0, 0),
+        )
+
+    def read_document(self, foldername, documentId):
+        table, key = STORE_TABLES.get(foldername, (None, None))
+        document = self.get_document(table, key, documentId) if table else None
+        return json.loads(document) if document is not None else None
+
+    def read_cached_document(self, foldername, documentId):
+        table, key = STORE_TABLES.get(foldername, (None, None))
+        filestat = self.document_stat(foldername, documentId)
+        if filestat is None:
+            return None
+
+        def serialize(source):
+            return self.get_document(table, key, documentId), "application/json"
+
+        source = "{}#{}/{}".format(self.path, foldername, documentId)
+        entry = self.cache.get(source, filestat, "document", serialize)
+        return json.loads(entry.data)
+
+    def document_stat(self, foldername, documentId):
+        """Returns the version and row count of a document in place of its
+        `os.stat` result or `None` if not found."""
+        table, key = STORE_TABLES.get(foldername, (None, None))
+        if table is None:
+            return None
+
+        if documentId == "index":
+            version = self.store.get_version(table)
+        else:
+            version = self.store.get_version(table, key, documentId)
+        return StoreStat(*version, st_ino=0) if version is not None else None
+
+    def document_mtime(self, foldername, documentId):
+        return None
+
+    def get_document(self, table, key, documentId):
+        if documentId == "index":
+            return self.store.get_documents(
+                "SELECT data FROM {} ORDER BY {}".format(table, key)
+            )
+        return self.store.get_document(table, key, documentId)
+
+    def find_foldlogdata(self, foldlogId):
+        if self.store.get_version("foldlogdata", "foldlogId", foldlogId) is None:
+            return None
+        return self.path + "#" + foldlogId
+
+    def stat(self, source):
+        foldlogId = self.get_foldlogId(source)
+        version = self.store.get_version("foldlogdata", "foldlogId", foldlogId)
+        return StoreStat(*(version or (0, 0)), st_ino=0)
+
+    def open_foldlogdata(self, source, after=None):
+        foldlogId = self.get_foldlogId(source)
+        epochIds, confmats, epochdata, policies = self.store.get_epochs(
+            foldlogId, after
+        )
+        return FoldLogDataReader(
+            foldlogId, epochIds, confmats, source, epochdata, policies
+        )
+
+    def get_foldlogId(self, source):
+        return source[slice(len(self.path) + 1, None)]
+
+    def get_filepath(self, source):
+        return None
+
+    def get_metrics_file(self, foldlogId, source):
+        return None
+
+    def get_pyramid(self, foldlogId, source):
+        return Pyramid.from_reader(self.open_foldlogdata(source))
+
+    def get_watcher(self):
+        if self.watcher is None:
+            self.watcher = SQLiteWatcher(self.store)
+        return self.watcher
+
+
+class LogDirRegistry:
+    """
+    A LogDirRegistry maps names to the log directories served by one server.
+
+    Log directories are either added by name or found in `rootdir` as
+    subdirectories containing a `runs` folder or as SQLite databases. Log
+    directories created in `rootdir` while the server is running are picked up
+    on their first request.
+    The default log directory is served under `/api`, all log directories are
+    served under `/api/<name>`.
+    """
+
+    def __init__(self, cachesize, rootdir=None, diskcache=None):
+        self.cachesize = cachesize
+        self.diskcache = diskcache
+        self.rootdir = check_folderpath(rootdir) if rootdir is not None else None
+        self.default = None
+        self.logdirs = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, name, path, default=False):
+        """Adds the log directory `path` as `name`, the default log directory is
+        only served under `/api` if `name` is not a valid name."""
+        if not is_valid_name(name) and not default:
+            raise ValueError("`{}` is not a valid logdir name".format(name))
+
+        logdir = create_logdir(name, path, self.cachesize, self.diskcache)
+        with self.lock:
+            if is_valid_name(name):
+                self.logdirs[name] = logdir
+            if default:
+                self.default = logdir
+        return logdir
+
+    def get(self, name=None):
+        """Returns the LogDir `name`, the default LogDir if no name is given or
+        `None` if there is no such log directory."""
+        if name is None:
+            return self.default
+
+        with self.lock:
+            logdir = self.logdirs.get(name)
+            if logdir is None and self.is_logdir(name):
+                path = os.path.join(self.rootdir, name)
+                logdir = create_logdir(name, path, self.cachesize, self.diskcache)
+                self.logdirs[name] = logdir
+        return logdir
+
+    def names(self):
+        with self.lock:
+            names = list(self.logdirs)
+        return names + [name for name in self.find_names() if name not in names]
+
+    def find_names(self):
+        """Returns the names of the log directories in `rootdir`."""
+        if self.rootdir is None:
+            return []
+
+        return [
+            name for name in sorted(os.listdir(self.rootdir)) if self.is_logdir(name)
+        ]
+
+    def is_logdir(self, name):
+        """Checks whether `rootdir` contains a log directory `name`."""
+        if self.rootdir is None or not is_valid_name(name):
+            return False
+
+        path = os.path.join(self.rootdir, name)
+        if is_sqlite_path(path):
+            return os.path.isfile(path)
+        return os.path.isdir(os.path.join(path, "runs"))
+
+
+def load_pyramid(lodpath, version):
+    """Returns the Pyramid in `lodpath` or `None` if it is missing or was built
+    from another `version` of the foldlog data."""
+    try:
+        return Pyramid.load(lodpath, source=version)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def create_logdir(name, path, cachesize, diskcache=None):
+    if is_sqlite_path(path):
+        return SQLiteLogDir(name, path, cachesize, diskcache)
+    return LogDir(name, path, cachesize, diskcache)
+
+
+def is_valid_name(name):
+    return (
+        bool(name)
+        and name not in RESERVED_NAMES
+        and not name.startswith(".")
+        and "/" not in name
+        and os.sep not in name
+    )
@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import threading
+
+import gevent
+
+from confusionflow.server.compare import compare_readers
+from confusionflow.server.reader import ReaderCache, open_foldlogdata
+
+NPY_MIMETYPE = "application/x-npy"
+
+# memory-mapped readers of the processes of a CPUPool
+READERS = ReaderCache()
+
+
+class CPUPool:
+    """
+    A CPUPool serializes responses in separate processes, so that the
+    serialization of a large foldlog does not block the other greenlets of a
+    server process.
+
+    The processes are started on first use, i.e. in every worker process after
+    the server forked its workers. The calling greenlet waits in a thread of
+    gevent's threadpool while the other greenlets keep running.
+    Only the functions of this module are run in the pool, they open the
+    foldlog data by path.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def apply(self, func, *args):
+        """Returns `func(*args)` computed in a process of the pool."""
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = multiprocessing.Pool(self.processes)
+                self.pid = os.getpid()
+            result = self.pool.apply_async(func, args)
+
+        # errors are raised by `get` in the calling greenlet
+        gevent.get_hub().threadpool.apply(result.wait)
+        return result.get()
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None and self.pid == os.getpid():
+                self.pool.terminate()
+            self.pool = None
+
+
+def serialize_json(reader, encoding=None):
+    return json.dumps(reader.asdict(encoding)), "application/json"
+
+
+def serialize_npy(reader):
+    return reader.tobytes(), NPY_MIMETYPE
+
+
+def serialize_header(reader):
+    return json.dumps(reader.header()), "application/json"
+
+
+def serialize_metrics(reader):
+    return json.dumps(reader.metrics()), "application/json"
+
+
+def serialize_subset(reader, indices, classnames):
+    return json.dumps(reader.subset(indices, classnames)), "application/json"
+
+
+SERIALIZERS = {
+    "json": serialize_json,
+    "npy": serialize_npy,
+    "header": serialize_header,
+    "metrics": serialize_metrics,
+    "subset": serialize_subset,
+}
+
+
+def serialize_reader(reader, name, options=None, selection=None):
+    """Returns the `(data, mimetype)` of the serializer `name` called with
+    `options` for the selected epochs of `reader`."""
+    if selection:
+        reader = reader.select(**selection)
+    return SERIALIZERS[name](reader, **(options or {}))
+
+
+def serialize_file(filepath, name, options=None, selection=None):
+    """Serializes the foldlog data in `filepath` like :py:func:`serialize_reader`."""
+    return serialize_reader(open_file(filepath), name, options, selection)
+
+
+def compare_files(filepaths, align, mode, selection=None):
+    """Compares the foldlog data in `filepaths` (see :py:func:`compare_readers`)."""
+    readers = [open_file(filepath) for filepath in filepaths]
+    comparison = compare_readers(readers, align, mode, selection)
+    return json.dumps(comparison), "application/json"
+
+
+def open_file(filepath):
+    if filepath.endswith(".npy"):
+        return READERS.get(filepath)
+    return open_foldlogdata(filepath)
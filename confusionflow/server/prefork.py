@@ -0,0 +1,174 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import os
+import signal
+import socket
+import time
+import traceback
+
+import gevent
+from gevent import pywsgi
+
+# seconds a stopping worker has to finish its open requests
+GRACEFUL_TIMEOUT = 30
+# workers exiting within RESTART_DELAY seconds of their start are restarted
+# after RESTART_DELAY seconds instead of immediately
+RESTART_DELAY = 1
+LISTEN_BACKLOG = 128
+
+
+class PreforkServer:
+    """
+    A PreforkServer serves the app returned by `create_app()` from several
+    worker processes, which accept connections from one listening socket.
+
+    The master process binds the socket, forks the workers and restarts
+    workers that exit. Every worker creates its own app and serves it with a
+    gevent WSGIServer. On SIGHUP a new set of workers is started and the old
+    workers finish their open requests before they exit, so that the server
+    picks up changes without dropping connections. On SIGTERM or SIGINT all
+    workers finish their open requests and the server stops.
+    Requests that take longer than `timeout` seconds are cut off.
+    """
+
+    def __init__(self, address, create_app, workers, timeout=GRACEFUL_TIMEOUT):
+        if not hasattr(os, "fork"):
+            raise RuntimeError("several workers are not supported on this platform")
+        self.address = address
+        self.create_app = create_app
+        self.numworkers = workers
+        self.timeout = timeout
+        self.socket = None
+        # pids of the current workers mapped to their start time
+        self.workers = dict()
+        # pids of the workers asked to stop mapped to the time they are killed
+        self.retiring = dict()
+        self.signals = []
+        self.delayed = 0
+
+    def serve_forever(self):
+        self.socket = create_socket(self.address)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handle_signal)
+
+        try:
+            while True:
+                if self.signals:
+                    if self.signals.pop(0) != signal.SIGHUP:
+                        break
+                    self.reload()
+                self.reap_workers()
+                self.spawn_workers()
+                time.sleep(0.1)
+        finally:
+            self.stop()
+            self.socket.close()
+
+    def handle_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def reload(self):
+        """Replaces all workers with new ones."""
+        old = list(self.workers)
+        self.workers = dict()
+        self.spawn_workers()
+        for pid in old:
+            self.retire_worker(pid)
+
+    def stop(self):
+        for pid in list(self.workers):
+            self.retire_worker(pid)
+        self.workers = dict()
+        while self.retiring:
+            self.reap_workers()
+            time.sleep(0.1)
+
+    def spawn_workers(self):
+        if time.time() < self.delayed:
+            return
+        while len(self.workers) < self.numworkers:
+            pid = os.fork()
+            if pid == 0:
+                self.run_worker()
+            self.workers[pid] = time.time()
+
+    def retire_worker(self, pid):
+        # give the worker some extra time to stop after its requests are cut off
+        self.retiring[pid] = time.time() + self.timeout + 5
+        kill(pid, signal.SIGTERM)
+
+    def reap_workers(self):
+        """Forgets the workers that exited and kills the workers that did not
+        stop in time."""
+        while self.workers or self.retiring:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                self.workers, self.retiring = dict(), dict()
+                return
+            if pid == 0:
+                break
+
+            if pid in self.workers:
+                started = self.workers.pop(pid)
+                print("Worker {} exited, restarting it".format(pid))
+                if time.time() - started < RESTART_DELAY:
+                    self.delayed = time.time() + RESTART_DELAY
+            self.retiring.pop(pid, None)
+
+        for pid, deadline in list(self.retiring.items()):
+            if time.time() > deadline:
+                kill(pid, signal.SIGKILL)
+
+    def run_worker(self):
+        """Serves the app in a forked worker process until it receives SIGTERM."""
+        status = 0
+        try:
+            # the master stops the workers on Ctrl+C and reloads them on SIGHUP
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            gevent.reinit()
+
+            app = self.create_app()
+            server = pywsgi.WSGIServer(self.socket, app)
+            gevent.signal_handler(
+                signal.SIGTERM, lambda: gevent.spawn(server.stop, self.timeout)
+            )
+            server.serve_forever()
+
+            pool = app.config.get("CPU_POOL")
+            if pool is not None:
+                pool.close()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+
+def create_socket(address):
+    """Returns a listening TCP socket bound to the `(host, port)` address."""
+    host, port = address
+    family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+        host, port, 0, socket.SOCK_STREAM
+    )[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(sockaddr)
+    sock.listen(LISTEN_BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+
+def kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
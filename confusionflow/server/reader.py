@@ -0,0 +1,386 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import io
+import json
+import os
+import threading
+
+import numpy as np
+
+from confusionflow.confmat import (
+    compute_metrics,
+    downcast_counts,
+    extract_submatrix,
+    get_confmat,
+    get_numclass,
+    sparsify,
+    stack_confmats,
+)
+from confusionflow.server.utils import get_version
+from confusionflow.utils import open_atomic, write_json_atomic
+
+ENCODINGS = ("dense", "sparse")
+MAX_READERS = 128
+
+
+class FoldLogDataReader:
+    """
+    A FoldLogDataReader gives access to the confusion matrices of a FoldLog
+    independent of the format the FoldLogData was exported with.
+
+    For JSON data the epochdata entries are kept as stored, dense or sparse, and
+    only stacked into a `(numepochs, numclass, numclass)` array when needed.
+    `policies` holds the logging policy recorded for each epoch, if any.
+    """
+
+    def __init__(
+        self, foldlogId, epochIds, confmats, filepath, epochdata=None, policies=None
+    ):
+        self.foldlogId = foldlogId
+        self.epochIds = epochIds
+        self.filepath = filepath
+        self.epochdata = epochdata
+        self.policies = policies
+        self._confmats = confmats
+
+    @classmethod
+    def from_json(cls, filepath):
+        with open(filepath, "r") as f:
+            data = json.load(f)
+
+        return cls.from_epochdata(data["foldlogId"], data["epochdata"], filepath)
+
+    @classmethod
+    def from_jsonl(cls, filepath):
+        """Reads a streamed foldlog, a partially written last line is skipped.
+
+        A file whose header is not written yet holds zero epochs.
+        """
+        with open(filepath, "r") as f:
+            lines = f.read().splitlines()
+
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            foldlogId = os.path.basename(filepath).rsplit("_data", 1)[0]
+            return cls.from_epochdata(foldlogId, [], filepath)
+
+        epochdata = list()
+        for line in lines[1:]:
+            try:
+                epochdata.append(json.loads(line))
+            except ValueError:
+                break
+
+        return cls.from_epochdata(header["foldlogId"], epochdata, filepath)
+
+    @classmethod
+    def from_epochdata(cls, foldlogId, epochdata, filepath):
+        epochIds = [entry["epochId"] for entry in epochdata]
+        policies = [entry.get("policy") for entry in epochdata]
+        if all(policy is None for policy in policies):
+            policies = None
+        return cls(foldlogId, epochIds, None, filepath, epochdata, policies)
+
+    @classmethod
+    def from_npy(cls, filepath, headerpath):
+        with open(headerpath, "r") as f:
+            header = json.load(f)
+
+        confmats = np.load(filepath, mmap_mode="r")
+        return cls(
+            header["foldlogId"],
+            header["epochIds"],
+            confmats,
+            filepath,
+            policies=header.get("policies"),
+        )
+
+    @property
+    def confmats(self):
+        if self._confmats is None:
+            self._confmats = stack_confmats(self.epochdata)
+        return self._confmats
+
+    def iter_confmats(self, chunksize):
+        """Yields the confusion matrices in chunks of `chunksize` epochs, JSON
+        data is only stacked one chunk at a time."""
+        for start in range(0, self.numepochs, chunksize):
+            chunk = slice(start, start + chunksize)
+            if self._confmats is None:
+                yield stack_confmats(self.epochdata[chunk])
+            else:
+                yield self._confmats[chunk]
+
+    @property
+    def numepochs(self):
+        return len(self.epochIds)
+
+    @property
+    def numclass(self):
+        if self._confmats is None:
+            return get_numclass(self.epochdata[0]) if self.epochdata else 0
+        return int(self._confmats.shape[1])
+
+    @property
+    def dtype(self):
+        if self._confmats is None:
+            return get_confmat(self.epochdata[0]).dtype if self.epochdata else None
+        return self._confmats.dtype
+
+    @property
+    def format(self):
+        return "npy" if self.filepath.endswith(".npy") else "json"
+
+    def select(self, epochIds=None, start=None, stop=None, stride=None):
+        """Returns a reader restricted to the epochs in `epochIds` or the epochs
+        with `start <= epochId <= stop`, keeping every `stride`-th epoch.
+
+        Only the selected confusion matrices are read from memory-mapped data.
+        """
+        ids = np.asarray(self.epochIds)
+        mask = np.ones(len(ids), dtype=bool)
+        if epochIds is not None:
+            mask &= np.isin(ids, epochIds)
+        if start is not None:
+            mask &= ids >= start
+        if stop is not None:
+            mask &= ids <= stop
+
+        index = np.flatnonzero(mask)[:: stride or 1]
+        epochIds = [self.epochIds[i] for i in index]
+        policies = None
+        if self.policies is not None:
+            policies = [self.policies[i] for i in index]
+        if self._confmats is None:
+            epochdata = [self.epochdata[i] for i in index]
+            return FoldLogDataReader(
+                self.foldlogId, epochIds, None, self.filepath, epochdata, policies
+            )
+
+        return FoldLogDataReader(
+            self.foldlogId,
+            epochIds,
+            self.confmats[index],
+            self.filepath,
+            policies=policies,
+        )
+
+    def header(self):
+        d = dict()
+        d["foldlogId"] = self.foldlogId
+        d["numepochs"] = self.numepochs
+        d["numclass"] = self.numclass
+        d["dtype"] = self.dtype.name if self.dtype is not None else None
+        d["epochIds"] = list(self.epochIds)
+        if self.policies is not None:
+            d["policies"] = list(self.policies)
+
+        return d
+
+    def metrics(self):
+        """Returns the accuracy and per-class precision, recall and F1 score
+        for every epoch."""
+        d = dict()
+        d["foldlogId"] = self.foldlogId
+        d["epochIds"] = list(self.epochIds)
+        if self.policies is not None:
+            d["policies"] = list(self.policies)
+        for name, values in compute_metrics(self.confmats).items():
+            d[name] = values.tolist()
+
+        return d
+
+    def subset(self, indices, classnames):
+        """Returns the confusion matrices between the classes in `indices` with
+        an additional class `other` aggregating all remaining classes."""
+        confmats = extract_submatrix(self.confmats, indices)
+
+        d = dict()
+        d["foldlogId"] = self.foldlogId
+        d["classIndices"] = list(indices)
+        d["classes"] = list(classnames) + ["other"]
+        d["numepochs"] = self.numepochs
+        d["epochdata"] = [
+            {"epochId": epochId, "confmat": confmat.flatten().tolist()}
+            for epochId, confmat in zip(self.epochIds, confmats)
+        ]
+        self.add_policies(d["epochdata"])
+
+        return d
+
+    def asdict(self, encoding=None):
+        """Returns the foldlog data with all confusion matrices in the `dense`
+        or `sparse` encoding, or as stored if no encoding is given."""
+        if self._confmats is None:
+            confmats = (get_confmat(entry) for entry in self.epochdata)
+        else:
+            confmats = (confmat.ravel() for confmat in self._confmats)
+
+        if encoding is None and self._confmats is None:
+            epochdata = self.epochdata
+        elif encoding == "sparse":
+            epochdata = [
+                {"epochId": epochId, "confmat_sparse": sparsify(confmat)}
+                for epochId, confmat in zip(self.epochIds, confmats)
+            ]
+        else:
+            epochdata = [
+                {"epochId": epochId, "confmat": confmat.tolist()}
+                for epochId, confmat in zip(self.epochIds, confmats)
+            ]
+
+        if epochdata is not self.epochdata:
+            self.add_policies(epochdata)
+
+        d = dict()
+        d["foldlogId"] = self.foldlogId
+        d["numepochs"] = self.numepochs
+        d["epochdata"] = epochdata
+
+        return d
+
+    def add_policies(self, epochdata):
+        if self.policies is None:
+            return
+        for entry, policy in zip(epochdata, self.policies):
+            if policy is not None:
+                entry["policy"] = policy
+
+    def tobytes(self):
+        """Returns the confusion matrices encoded in the `.npy` format."""
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(self.confmats))
+        return buffer.getvalue()
+
+
+class ReaderCache:
+    """
+    A ReaderCache shares the readers of memory-mapped foldlog data between the
+    requests of a server.
+
+    A reader is reused until its file or `.header.json` changes on disk. Its
+    confusion matrices are pages of the file mapped into memory, which the
+    operating system shares between all greenlets and worker processes reading
+    the file instead of copying them into the memory of every process.
+    The least recently used readers are closed once more than `maxitems` are
+    open.
+    """
+
+    def __init__(self, maxitems=MAX_READERS):
+        self.maxitems = maxitems
+        self.readers = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, filepath, open_reader=None):
+        """Returns the reader for `filepath`, which is opened with
+        `open_reader(filepath)` if it is not cached or the file changed."""
+        paths = [filepath]
+        if filepath.endswith(".npy"):
+            paths.append(get_headerpath(filepath))
+        version = [get_version(os.stat(path)) for path in paths]
+        with self.lock:
+            entry = self.readers.pop(filepath, None)
+            if entry is not None and entry[0] == version:
+                self.readers[filepath] = entry
+                return entry[1]
+
+        reader = (open_reader or open_foldlogdata)(filepath)
+        with self.lock:
+            self.readers[filepath] = (version, reader)
+            while len(self.readers) > self.maxitems:
+                self.readers.popitem(last=False)
+        return reader
+
+    def clear(self):
+        with self.lock:
+            self.readers.clear()
+
+
+def write_npy(reader, filepath, source=None):
+    """Writes the confusion matrices of `reader` to the `.npy` file
+    `filepath` with a `.header.json` file as exported by FoldLogData, integer
+    counts are stored with the smallest unsigned dtype that fits.
+
+    `source` records the version of the file the data was read from.
+    """
+    confmats = downcast_counts(reader.confmats)
+
+    with open_atomic(filepath, "wb") as f:
+        np.save(f, confmats)
+
+    header = reader.header()
+    header["dtype"] = confmats.dtype.name
+    if source is not None:
+        header["source"] = list(source)
+    write_json_atomic(get_headerpath(filepath), header)
+
+
+def is_dense(reader):
+    """Checks whether all confusion matrices of `reader` are stored densely."""
+    if reader.epochdata is None:
+        return True
+    return all("confmat_sparse" not in entry for entry in reader.epochdata)
+
+
+def get_headerpath(filepath):
+    return os.path.splitext(filepath)[0] + ".header.json"
+
+
+def find_foldlogdata(foldername, foldlogId):
+    """Returns the path of the data for foldlog <foldlogId> located in
+    `foldername` or `None` if no data was found."""
+    basepath = os.path.join(foldername, foldlogId + "_data")
+
+    if os.path.isfile(basepath + ".npy") and os.path.isfile(basepath + ".header.json"):
+        return basepath + ".npy"
+
+    for suffix in [".json", ".jsonl"]:
+        if os.path.isfile(basepath + suffix):
+            return basepath + suffix
+
+    return None
+
+
+def read_jsonl_epochs(filepath, offset=0):
+    """Reads the epochs appended to a streamed `.jsonl` foldlog after byte
+    `offset` and returns them with the offset to continue reading from.
+
+    A partially written last line is left for the next read.
+    """
+    with open(filepath, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+
+    end = data.rfind(b"\n") + 1
+    lines = data[:end].decode("utf-8").splitlines()
+    if offset == 0:
+        lines = lines[1:]
+
+    epochdata = [json.loads(line) for line in lines if line.strip()]
+    return epochdata, offset + end
+
+
+def parse_epochId(value):
+    """Parses an epochId, epochs logged within an epoch have fractional ids."""
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def open_foldlogdata(filepath):
+    """Opens the foldlog data stored in `filepath`.
+
+    Binary `.npy` data is memory-mapped, data that is still streamed to a
+    `.jsonl` file contains all epochs written so far.
+    """
+    if filepath.endswith(".npy"):
+        return FoldLogDataReader.from_npy(filepath, get_headerpath(filepath))
+    elif filepath.endswith(".jsonl"):
+        return FoldLogDataReader.from_jsonl(filepath)
+    else:
+        return FoldLogDataReader.from_json(filepath)
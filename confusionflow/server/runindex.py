@@ -0,0 +1,254 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import fnmatch
+import json
+import threading
+import time
+
+from confusionflow.confmat import compute_metrics
+from confusionflow.server.utils import get_version
+
+SORT_KEYS = ("runId", "exported", "accuracy")
+
+# minimum seconds between two reads of a changed run index, e.g. while runs are
+# streamed and the index changes continuously
+REFRESH_INTERVAL = 2.0
+
+
+class RunIndex:
+    """
+    A RunIndex keeps the run index of a log directory in memory to answer
+    paginated, filtered and sorted queries without sending the whole index.
+
+    The index is read once and read again only after the run or dataset index
+    changed, at most every `REFRESH_INTERVAL` seconds, the export times and
+    final accuracies of unchanged runs are kept.
+    Final accuracies are taken from the foldlog summaries in the index, for
+    runs exported without summaries they are computed from the foldlog data
+    on the first query sorting by them and again once the data changes.
+    """
+
+    def __init__(self, logdir):
+        self.logdir = logdir
+        self.version = None
+        self.refreshed = 0.0
+        self.runs = []
+        self.exported = dict()
+        self.datasets = dict()
+        self.accuracies = dict()
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Reads the run index again if it changed since the last refresh and
+        that refresh is at least `REFRESH_INTERVAL` seconds ago."""
+        now = time.time()
+        if self.version is not None and now - self.refreshed < REFRESH_INTERVAL:
+            return
+
+        version = (
+            get_version(self.logdir.document_stat("runs", "index")),
+            get_version(self.logdir.document_stat("datasets", "index")),
+        )
+        with self.lock:
+            if version == self.version:
+                return
+
+            previous = dict((run["runId"], run) for run in self.runs)
+            runs = self.logdir.read_document("runs", "index") or []
+            exported = dict()
+            for run in runs:
+                runId = run["runId"]
+                if previous.get(runId) == run and runId in self.exported:
+                    exported[runId] = self.exported[runId]
+                else:
+                    exported[runId] = self.get_exported(run)
+
+            datasets = dict()
+            for dataset in self.logdir.read_document("datasets", "index") or []:
+                for fold in dataset["folds"]:
+                    datasets[fold["foldId"]] = dataset["datasetId"]
+
+            self.runs, self.exported, self.datasets = runs, exported, datasets
+            self.version = version
+            self.refreshed = now
+
+    def get_exported(self, run):
+        """Returns the export time of `run`, which falls back to the mtime of
+        the run file for runs exported before it was recorded."""
+        if "exported" in run:
+            return run["exported"]
+        return self.logdir.document_mtime("runs", run["runId"])
+
+    def get_accuracy(self, run, foldId=None):
+        """Returns the accuracy at the last epoch of the foldlog of `run` for
+        fold `foldId` (the train fold by default) or `None` if not logged.
+
+        The accuracy is taken from the summary of the foldlog in the run index
+        and computed from the foldlog data for foldlogs exported without a
+        summary.
+        """
+        foldId = foldId or run["trainfoldId"]
+        foldlogs = [
+            foldlog for foldlog in run["foldlogs"] if foldlog["foldId"] == foldId
+        ]
+        if not foldlogs:
+            return None
+
+        foldlog = foldlogs[0]
+        if "summary" in foldlog:
+            return foldlog["summary"]["final"]["accuracy"]
+
+        foldlogId = foldlog["foldlogId"]
+        source = self.logdir.find_foldlogdata(foldlogId)
+        if source is None:
+            return None
+
+        version = (source, get_version(self.logdir.stat(source)))
+        cached = self.accuracies.get(foldlogId)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        accuracy = self.compute_accuracy(source)
+        self.accuracies[foldlogId] = (version, accuracy)
+        return accuracy
+
+    def compute_accuracy(self, source):
+        try:
+            reader = self.logdir.open_foldlogdata(source)
+        except (IOError, OSError, ValueError):
+            return None
+        if not reader.numepochs:
+            return None
+        return float(compute_metrics(reader.confmats[-1:])["accuracy"][0])
+
+    def query(
+        self,
+        runId=None,
+        dataset=None,
+        trainfoldId=None,
+        hyperparam=None,
+        sort="runId",
+        reverse=False,
+        foldId=None,
+        cursor=None,
+        offset=0,
+        limit=None,
+    ):
+        """Returns a page of the runs matching all given filters.
+
+        `runId` is a shell-style pattern, `dataset` matches runs with a fold of
+        the dataset and `hyperparam` maps hyperparameter names to the string
+        representation of their values.
+        The runs are sorted by `sort`, runs without a value for the sort key
+        come last. A page skips `offset` runs, counted from the first run or
+        from the end of the previous page given by its `cursor`, and contains
+        up to `limit` runs.
+        """
+        self.refresh()
+        with self.lock:
+            runs, exported, datasets = self.runs, self.exported, self.datasets
+
+        matches = []
+        for run in runs:
+            if runId is not None and not fnmatch.fnmatchcase(run["runId"], runId):
+                continue
+            if trainfoldId is not None and run["trainfoldId"] != trainfoldId:
+                continue
+            if dataset is not None and not any(
+                datasets.get(foldlog["foldId"]) == dataset
+                for foldlog in run["foldlogs"]
+            ):
+                continue
+            if hyperparam and not match_hyperparam(run, hyperparam):
+                continue
+            matches.append(run)
+
+        keys = dict()
+        for run in matches:
+            if sort == "exported":
+                value = exported.get(run["runId"])
+            elif sort == "accuracy":
+                value = self.get_accuracy(run, foldId)
+            else:
+                value = run["runId"]
+            keys[run["runId"]] = make_sortkey(value, run["runId"])
+
+        matches.sort(key=lambda run: keys[run["runId"]][1:], reverse=reverse)
+        matches.sort(key=lambda run: keys[run["runId"]][0])
+
+        start = 0
+        if cursor is not None:
+            start = len(matches)
+            try:
+                for i, run in enumerate(matches):
+                    if is_after(keys[run["runId"]], cursor, reverse):
+                        start = i
+                        break
+            except TypeError:
+                # the cursor belongs to a page sorted by another key
+                raise ValueError("invalid cursor")
+        page = matches[slice(start + offset, None)]
+        if limit is not None:
+            page = page[slice(None, limit)]
+
+        nextcursor = None
+        if page and start + offset + len(page) < len(matches):
+            nextcursor = encode_cursor(keys[page[-1]["runId"]])
+
+        return {
+            "total": len(matches),
+            "runs": page,
+            "next": nextcursor,
+        }
+
+
+def match_hyperparam(run, hyperparam):
+    values = run.get("hyperparam") or dict()
+    for name, value in hyperparam.items():
+        if name not in values or format_value(values[name]) != value:
+            return False
+    return True
+
+
+def format_value(value):
+    """Returns the representation of a hyperparameter value used in queries,
+    strings as they are and all other values as JSON."""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def make_sortkey(value, runId):
+    """Returns the sort key of a run, a missing `value` sorts after all others."""
+    if value is None:
+        return (1, 0, runId)
+    return (0, value, runId)
+
+
+def is_after(key, cursor, reverse=False):
+    """Checks whether a run with sort key `key` comes after `cursor`."""
+    if key[0] != cursor[0]:
+        return key[0] > cursor[0]
+    if reverse:
+        return key[1:] < cursor[1:]
+    return key[1:] > cursor[1:]
+
+
+def encode_cursor(key):
+    data = json.dumps(list(key)).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor returned with a page, raises a ValueError if it is
+    not valid."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode())
+    except (TypeError, UnicodeError, ValueError):
+        raise ValueError("invalid cursor")
+    if not isinstance(key, list) or len(key) != 3:
+        raise ValueError("invalid cursor")
+    return tuple(key)
@@ -2,13 +2,259 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+import gzip
+import io
+import mimetypes
 import os
+import stat
+import time
 
-from flask import send_from_directory
+import gevent
+from flask import Response, request, send_from_directory
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-def serve_file(foldername, filename, errormsg):
-    if not os.path.isfile(os.path.join(foldername, filename)):
+try:
+    from werkzeug.utils import safe_join
+except ImportError:  # werkzeug < 2.0
+    from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+COMPRESS_MIN_SIZE = 1024
+LOCK_TIMEOUT = 60
+LOCK_INTERVAL = 0.05
+COMPRESSIBLE_MIMETYPES = [
+    "application/javascript",
+    "application/json",
+    "application/octet-stream",
+    "application/x-npy",
+    "image/svg+xml",
+]
+
+
+def serve_file(foldername, filename, errormsg, cache=None):
+    """Serves `filename` from `foldername`, returns `errormsg` if not found.
+
+    If a FileCache is supplied the file is served from memory as long as it
+    has not changed on disk. Responses carry a strong ETag and are answered
+    with `304 Not Modified` if the client already has the current version.
+    Responses are compressed if the client accepts it, an up-to-date `.gz`
+    sidecar file written at export time is served instead of compressing.
+    """
+    filepath = safe_join(foldername, filename)
+    filestat = stat_file(filepath)
+    if filestat is None:
         return errormsg
+
+    encoding = get_accepted_encoding()
+    sidecarstat = None
+    if encoding is not None and request.accept_encodings["gzip"]:
+        sidecarstat = stat_file(filepath + ".gz")
+        if sidecarstat is not None and sidecarstat.st_mtime >= filestat.st_mtime:
+            filename, filepath, filestat = (
+                filename + ".gz",
+                filepath + ".gz",
+                sidecarstat,
+            )
+            encoding = "gzip"
+        else:
+            sidecarstat = None
+
+    mimetype = guess_mimetype(filepath)
+    if sidecarstat is None and not is_compressible(filestat.st_size, mimetype):
+        encoding = None
+
+    if cache is None or not cache.accepts(filestat.st_size):
+        response = send_from_directory(foldername, filename, mimetype=mimetype)
+        if sidecarstat is not None:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
+
+    if sidecarstat is not None or encoding is None:
+        entry = cache.get(filepath, filestat)
     else:
-        return send_from_directory(foldername, filename)
+        entry = cache.get(filepath, filestat, encoding, compress_file(encoding))
+
+    return make_conditional_response(
+        entry.data, mimetype, entry, encoding, encoding=encoding
+    )
+
+
+def serve_serialized(filepath, variant, serialize, cache=None, filestat=None):
+    """Serves the response `serialize(filepath)` derived from `filepath`.
+
+    If a FileCache is supplied the serialized response is reused until the file
+    changes on disk. The response is compressed if the client accepts it.
+    `filestat` replaces the `os.stat` result of `filepath` for data that is not
+    stored in a file.
+    """
+    if filestat is None:
+        filestat = os.stat(filepath)
+    encoding = get_accepted_encoding()
+    if encoding is not None:
+        serialize = compress_serialized(serialize, encoding)
+        variant = variant + "+" + encoding
+
+    if cache is None:
+        data, mimetype = serialize(filepath)
+    else:
+        entry = cache.get(filepath, filestat, variant, serialize)
+        data, mimetype = entry.data, entry.mimetype
+
+    return make_conditional_response(
+        data, mimetype, filestat, variant, encoding=encoding
+    )
+
+
+def make_conditional_response(data, mimetype, filestat, variant=None, encoding=None):
+    """Creates a response with an ETag derived from `filestat` that turns into
+    `304 Not Modified` if it matches the `If-None-Match` header."""
+    response = Response(data, mimetype=mimetype)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.set_etag(make_etag(filestat, variant))
+    return response.make_conditional(request)
+
+
+def make_etag(filestat, variant=None):
+    """Returns a strong ETag based on inode, size and mtime of a file, `filestat`
+    can either be an `os.stat` result or a CacheEntry."""
+    if hasattr(filestat, "st_ino"):
+        inode, size, mtime = filestat.st_ino, filestat.st_size, filestat.st_mtime
+    else:
+        inode, size, mtime = filestat.inode, filestat.size, filestat.mtime
+
+    etag = "{:x}-{:x}-{:x}".format(inode, size, int(mtime * 1e6))
+    if variant is not None:
+        etag += "-" + variant
+
+    return etag
+
+
+@contextlib.contextmanager
+def lock_file(lockpath, timeout=LOCK_TIMEOUT):
+    """Holds an exclusive lock on `lockpath` shared by the server processes,
+    other greenlets keep running while waiting for it.
+
+    Yields whether the lock is held, `False` if the lock file cannot be created
+    (read-only logdir) or the lock is not acquired within `timeout` seconds.
+    Without `fcntl` nothing is locked and `True` is yielded.
+    """
+    try:
+        lockfile = open(lockpath, "a")
+    except (IOError, OSError):
+        yield False
+        return
+
+    with lockfile:
+        locked = fcntl is None
+        deadline = time.time() + timeout
+        while not locked:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+            except (IOError, OSError):
+                if time.time() >= deadline:
+                    break
+                gevent.sleep(LOCK_INTERVAL)
+
+        try:
+            yield locked
+        finally:
+            if locked and fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def get_version(filestat):
+    """Returns the version `[mtime, size, inode]` of a file given by its
+    `os.stat` result or `None` without one. Files derived from another file
+    record its version to detect any replacement, not only newer mtimes."""
+    if filestat is None:
+        return None
+    return [filestat.st_mtime, filestat.st_size, filestat.st_ino]
+
+
+def stat_file(filepath):
+    """Returns the `os.stat` result of `filepath` or `None` if it is no file."""
+    try:
+        filestat = os.stat(filepath) if filepath is not None else None
+    except OSError:
+        return None
+
+    return filestat if filestat is not None and stat.S_ISREG(filestat.st_mode) else None
+
+
+def guess_mimetype(filepath):
+    return mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+
+
+def get_accepted_encoding():
+    """Returns the preferred encoding of the client, `None` for identity."""
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def is_compressible(size, mimetype):
+    return size >= COMPRESS_MIN_SIZE and (
+        mimetype.startswith("text/") or mimetype in COMPRESSIBLE_MIMETYPES
+    )
+
+
+def compress(data, encoding):
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+
+    if encoding == "br":
+        return brotli.compress(data)
+
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def compress_file(encoding):
+    def serialize(filepath):
+        with open(filepath, "rb") as f:
+            return compress(f.read(), encoding), guess_mimetype(filepath)
+
+    return serialize
+
+
+def compress_serialized(serialize, encoding):
+    def compressed(filepath):
+        data, mimetype = serialize(filepath)
+        return compress(data, encoding), mimetype
+
+    return compressed
+
+
+def compress_response(response):
+    """Compresses responses that were not already compressed when served."""
+    encoding = get_accepted_encoding()
+    if (
+        encoding is None
+        or response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+
+    data = response.get_data()
+    if is_compressible(len(data), response.mimetype):
+        response.set_data(compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+
+    return response
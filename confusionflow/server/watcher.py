@@ -0,0 +1,167 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+
+import gevent
+import gevent.event
+import gevent.select
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+WATCHED_FOLDERS = ("runs", "foldlogdata")
+POLL_INTERVAL = 1.0
+MAX_CHANGES = 1024
+
+
+class LogDirWatcher:
+    """
+    A LogDirWatcher watches the `runs` and `foldlogdata` folders of a log
+    directory for changed files.
+
+    Changes are detected with inotify if the optional `inotify_simple` package
+    is installed on Linux and by polling the folders every `interval` seconds
+    otherwise. The watcher runs in a greenlet of the gevent server as long as
+    clients are subscribed and is shared by all of them.
+    """
+
+    def __init__(self, path, interval=POLL_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.generation = 0
+        self.changes = collections.deque(maxlen=MAX_CHANGES)
+        self.event = gevent.event.Event()
+        self.subscribers = 0
+        self.greenlet = None
+
+    def subscribe(self):
+        """Starts watching and returns the current generation of changes."""
+        self.subscribers += 1
+        if self.greenlet is None or self.greenlet.dead:
+            self.greenlet = gevent.spawn(self.run)
+            # let the watcher start, so no changes are missed after subscribing
+            gevent.sleep(0)
+        return self.generation
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+
+    def wait(self, generation, timeout=None):
+        """Waits until files changed after `generation` or `timeout` passed.
+
+        Returns the new generation and the set of changed paths relative to the
+        log directory, e.g. `runs/index.json`. The set is `None` if the changes
+        are no longer known and all files have to be checked.
+        """
+        if generation == self.generation:
+            self.event.wait(timeout)
+
+        if generation == self.generation:
+            return generation, set()
+        if not self.changes or self.changes[0][0] > generation + 1:
+            return self.generation, None
+
+        changed = set()
+        for changegeneration, paths in self.changes:
+            if changegeneration > generation:
+                changed.update(paths)
+        return self.generation, changed
+
+    def notify(self, paths):
+        self.generation += 1
+        self.changes.append((self.generation, paths))
+        event, self.event = self.event, gevent.event.Event()
+        event.set()
+
+    def run(self):
+        if inotify_simple is not None:
+            try:
+                return self.watch_inotify()
+            except OSError:
+                pass
+        self.watch_polling()
+
+    def watch_inotify(self):
+        flags = inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MODIFY | flags.MOVED_TO | flags.DELETE
+        inotify = inotify_simple.INotify()
+        try:
+            folders = dict()
+            for folder in WATCHED_FOLDERS:
+                folderpath = os.path.join(self.path, folder)
+                if os.path.isdir(folderpath):
+                    folders[inotify.add_watch(folderpath, mask)] = folder
+
+            while self.subscribers > 0:
+                readable, _, _ = gevent.select.select(
+                    [inotify.fileno()], [], [], self.interval
+                )
+                if not readable:
+                    continue
+                paths = set(
+                    folders[event.wd] + "/" + event.name
+                    for event in inotify.read(timeout=0)
+                    if event.wd in folders and event.name
+                )
+                if paths:
+                    self.notify(paths)
+        finally:
+            inotify.close()
+
+    def watch_polling(self):
+        stats = self.scan()
+        while self.subscribers > 0:
+            gevent.sleep(self.interval)
+            current = self.scan()
+            paths = set(
+                path
+                for path in set(stats) | set(current)
+                if stats.get(path) != current.get(path)
+            )
+            stats = current
+            if paths:
+                self.notify(paths)
+
+    def scan(self):
+        """Returns the mtime, size and inode of all files in the watched folders."""
+        stats = dict()
+        for folder in WATCHED_FOLDERS:
+            folderpath = os.path.join(self.path, folder)
+            if not os.path.isdir(folderpath):
+                continue
+            for filename in os.listdir(folderpath):
+                try:
+                    filestat = os.stat(os.path.join(folderpath, filename))
+                except OSError:
+                    continue
+                stats[folder + "/" + filename] = (
+                    filestat.st_mtime,
+                    filestat.st_size,
+                    filestat.st_ino,
+                )
+
+        return stats
+
+
+class SQLiteWatcher(LogDirWatcher):
+    """
+    A SQLiteWatcher polls a SQLiteStore for rows written since the last poll
+    and reports them as the changed files of the folder layout.
+    """
+
+    def __init__(self, store, interval=POLL_INTERVAL):
+        LogDirWatcher.__init__(self, store.path, interval)
+        self.store = store
+
+    def run(self):
+        version = self.store.get_version_number()
+        while self.subscribers > 0:
+            gevent.sleep(self.interval)
+            version, paths = self.store.get_changes(version)
+            if paths:
+                self.notify(paths)
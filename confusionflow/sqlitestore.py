@@ -0,0 +1,406 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from confusionflow.confmat import downcast_counts
+
+try:
+    from urllib.parse import quote
+except ImportError:  # Python 2
+    from urllib import quote
+
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (version INTEGER NOT NULL);
+INSERT INTO meta (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM meta);
+CREATE TABLE IF NOT EXISTS runs (
+    runId TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_version ON runs (version);
+CREATE TABLE IF NOT EXISTS foldlogs (
+    foldlogId TEXT PRIMARY KEY,
+    runId TEXT NOT NULL,
+    foldId TEXT NOT NULL,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS foldlogs_runId ON foldlogs (runId);
+CREATE INDEX IF NOT EXISTS foldlogs_foldId ON foldlogs (foldId);
+CREATE TABLE IF NOT EXISTS datasets (
+    datasetId TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS foldlogdata (
+    foldlogId TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS foldlogdata_version ON foldlogdata (version);
+CREATE TABLE IF NOT EXISTS epochs (
+    foldlogId TEXT NOT NULL,
+    epochId NUMERIC NOT NULL,
+    numclass INTEGER NOT NULL,
+    dtype TEXT NOT NULL,
+    confmat BLOB NOT NULL,
+    confmat_index BLOB,
+    policy TEXT,
+    PRIMARY KEY (foldlogId, epochId)
+);
+"""
+
+
+def is_sqlite_path(logdir):
+    """Checks whether `logdir` refers to a SQLite store instead of a folder."""
+    return str(logdir).lower().endswith(SQLITE_SUFFIXES)
+
+
+STORES = dict()
+STORES_LOCK = threading.Lock()
+
+
+def open_store(path):
+    """Returns the SQLiteStore of `path` shared by all writers of this process.
+
+    Its connections stay open, so that streaming an epoch only writes the
+    epoch instead of setting up the database again.
+    """
+    path = os.path.realpath(path)
+    with STORES_LOCK:
+        store = STORES.get(path)
+        if store is None or not os.path.isfile(path):
+            store = STORES[path] = SQLiteStore(path)
+    return store
+
+
+class SQLiteStore:
+    """
+    A SQLiteStore keeps the runs, foldlogs, datasets and confusion matrices of a
+    log directory in a single SQLite file.
+
+    Runs, foldlogs and datasets are stored as the JSON documents of the
+    folder layout, the confusion matrices of every epoch as a binary blob.
+    The database uses write-ahead logging, so that several processes can export
+    to the same file while the server reads from it.
+    Every write increments the version of the store, the rows it wrote are
+    stamped with the new version to find changes.
+    A `readonly` store, as opened by the server, neither sets up nor writes
+    the database.
+    """
+
+    def __init__(self, path, timeout=30.0, readonly=False):
+        self.path = os.path.realpath(path)
+        self.timeout = timeout
+        self.readonly = readonly
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        """The connection of the current thread."""
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            if not self.local.empty or not has_schema(connection):
+                return connection
+            # the schema was created since, the temporary tables would hide it
+            self.close()
+
+        self.local.empty = False
+        if self.readonly:
+            connection = sqlite3.connect(
+                "file:{}?mode=ro".format(quote(self.path)),
+                timeout=self.timeout,
+                isolation_level=None,
+                uri=True,
+            )
+            if not has_schema(connection):
+                # nothing was exported yet, the connection serves empty
+                # temporary tables until the schema exists
+                for statement in get_statements():
+                    connection.execute(
+                        statement.replace("CREATE TABLE", "CREATE TEMP TABLE")
+                    )
+                self.local.empty = True
+        else:
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with self.transaction(connection, bump=False):
+                for statement in get_statements():
+                    connection.execute(statement)
+
+        self.local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+            self.local.empty = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextlib.contextmanager
+    def transaction(self, connection=None, bump=True):
+        """Runs a write transaction and yields the new version of the store.
+
+        The write lock is acquired at the start of the transaction, writers of
+        other processes wait up to `timeout` seconds for it.
+        """
+        connection = connection or self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            version = None
+            if bump:
+                connection.execute("UPDATE meta SET version = version + 1")
+                version = connection.execute("SELECT version FROM meta").fetchone()[0]
+            yield version
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def put_run(self, run):
+        with self.transaction() as version:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO runs (runId, data, version) VALUES (?, ?, ?)",
+                (run["runId"], json.dumps(run), version),
+            )
+
+    def put_foldlog(self, foldlog):
+        with self.transaction() as version:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO foldlogs (foldlogId, runId, foldId, data, "
+                "version) VALUES (?, ?, ?, ?, ?)",
+                (
+                    foldlog["foldlogId"],
+                    foldlog["runId"],
+                    foldlog["foldId"],
+                    json.dumps(foldlog),
+                    version,
+                ),
+            )
+
+    def put_dataset(self, dataset):
+        with self.transaction() as version:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO datasets (datasetId, data, version) "
+                "VALUES (?, ?, ?)",
+                (dataset["datasetId"], json.dumps(dataset), version),
+            )
+
+    def put_epochdata(self, foldlogId, epochdata, replace=True):
+        """Stores the epochdata entries of foldlog `foldlogId`, replacing all
+        previously stored epochs unless `replace` is `False`."""
+        rows = [encode_epochdata(foldlogId, entry) for entry in epochdata]
+        with self.transaction() as version:
+            if replace:
+                self.connection.execute(
+                    "DELETE FROM epochs WHERE foldlogId = ?", (foldlogId,)
+                )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO epochs (foldlogId, epochId, numclass, dtype, "
+                "confmat, confmat_index, policy) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO foldlogdata (foldlogId, version) VALUES (?, ?)",
+                (foldlogId, version),
+            )
+
+    def append_epochdata(self, foldlogId, entry):
+        self.put_epochdata(foldlogId, [entry], replace=False)
+
+    def get_runs(self):
+        """Returns the run index as JSON text."""
+        return self.get_documents("SELECT data FROM runs ORDER BY runId")
+
+    def get_datasets(self):
+        """Returns the dataset index as JSON text."""
+        return self.get_documents("SELECT data FROM datasets ORDER BY datasetId")
+
+    def get_documents(self, query, parameters=()):
+        rows = self.connection.execute(query, parameters).fetchall()
+        return "[" + ", ".join(row[0] for row in rows) + "]"
+
+    def get_run(self, runId):
+        return self.get_document("runs", "runId", runId)
+
+    def get_foldlog(self, foldlogId):
+        return self.get_document("foldlogs", "foldlogId", foldlogId)
+
+    def get_dataset(self, datasetId):
+        return self.get_document("datasets", "datasetId", datasetId)
+
+    def get_document(self, table, key, value):
+        """Returns the JSON text of the row `value` of `table` or `None`."""
+        row = self.connection.execute(
+            "SELECT data FROM {} WHERE {} = ?".format(table, key), (value,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def get_version(self, table, key=None, value=None):
+        """Returns the version and number of rows of `table` or of row `value`,
+        which change whenever the table or row is written."""
+        query = "SELECT MAX(version), COUNT(*) FROM {}".format(table)
+        parameters = ()
+        if key is not None:
+            query += " WHERE {} = ?".format(key)
+            parameters = (value,)
+        version, count = self.connection.execute(query, parameters).fetchone()
+        if not count:
+            return None
+        return version, count
+
+    def get_epochs(self, foldlogId, after=None):
+        """Returns the epochIds, the confusion matrices, the epochdata and the
+        policies of foldlog `foldlogId`, restricted to the epochs after epochId
+        `after`.
+
+        If all epochs are stored dense, the confusion matrices are returned as
+        `(numepochs, numclass, numclass)` array and the epochdata as `None`.
+        Otherwise the epochdata entries are returned with the dense or sparse
+        confusion matrices as stored and the array as `None`.
+        """
+        query = (
+            "SELECT epochId, numclass, dtype, confmat, confmat_index, policy "
+            "FROM epochs WHERE foldlogId = ?"
+        )
+        parameters = (foldlogId,)
+        if after is not None:
+            query += " AND epochId > ?"
+            parameters += (after,)
+        rows = self.connection.execute(query + " ORDER BY epochId", parameters)
+
+        epochIds, epochdata, policies = [], [], []
+        for epochId, numclass, dtype, confmat, index, policy in rows:
+            epochIds.append(epochId)
+            epochdata.append(decode_confmat(numclass, dtype, confmat, index))
+            policies.append(json.loads(policy) if policy is not None else None)
+
+        if all(policy is None for policy in policies):
+            policies = None
+
+        if any(isinstance(entry, dict) for entry in epochdata):
+            for i, entry in enumerate(epochdata):
+                if isinstance(entry, dict):
+                    entry = {"epochId": epochIds[i], "confmat_sparse": entry}
+                else:
+                    entry = {"epochId": epochIds[i], "confmat": entry.ravel().tolist()}
+                if policies is not None and policies[i] is not None:
+                    entry["policy"] = policies[i]
+                epochdata[i] = entry
+            return epochIds, None, epochdata, policies
+
+        if epochdata:
+            confmats = np.stack(epochdata)
+        else:
+            confmats = np.zeros((0, 0, 0), dtype=np.int64)
+        return epochIds, confmats, None, policies
+
+    def get_version_number(self):
+        return self.connection.execute("SELECT version FROM meta").fetchone()[0]
+
+    def get_changes(self, version):
+        """Returns the current version of the store and the paths of the folder
+        layout that correspond to the rows written after `version`."""
+        current = self.get_version_number()
+        paths = set()
+        if current == version:
+            return current, paths
+
+        for table, key, folder in [
+            ("runs", "runId", "runs"),
+            ("datasets", "datasetId", "datasets"),
+            ("foldlogs", "foldlogId", "foldlogs"),
+        ]:
+            rows = self.connection.execute(
+                "SELECT {} FROM {} WHERE version > ?".format(key, table), (version,)
+            ).fetchall()
+            if rows:
+                paths.add(folder + "/index.json")
+            paths.update(folder + "/" + row[0] + ".json" for row in rows)
+
+        rows = self.connection.execute(
+            "SELECT foldlogId FROM foldlogdata WHERE version > ?", (version,)
+        ).fetchall()
+        paths.update("foldlogdata/" + row[0] + "_data.db" for row in rows)
+
+        return current, paths
+
+
+def has_schema(connection):
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'meta'"
+    return connection.execute(query).fetchone() is not None
+
+
+def get_statements():
+    return [statement for statement in SCHEMA.split(";") if statement.strip()]
+
+
+def encode_epochdata(foldlogId, entry):
+    """Encodes an epochdata entry as a row of the `epochs` table.
+
+    Dense confusion matrices are stored as a blob of all cells, sparse ones as
+    a blob of the non-zero values and a blob `confmat_index` of their flat
+    indices. The values are stored with the smallest dtype that fits.
+    """
+    index = None
+    if "confmat_sparse" in entry:
+        sparse = entry["confmat_sparse"]
+        numclass = sparse["numclass"]
+        confmat = np.asarray(sparse["value"])
+        if not confmat.size:
+            confmat = confmat.astype(np.uint8)
+        index = np.asarray(sparse["index"], dtype=get_index_dtype(numclass))
+        index = sqlite3.Binary(index.tobytes())
+    else:
+        confmat = np.asarray(entry["confmat"])
+        numclass = int(round(np.sqrt(confmat.size)))
+
+    confmat = downcast_counts(confmat)
+    policy = entry.get("policy")
+
+    return (
+        foldlogId,
+        entry["epochId"],
+        numclass,
+        confmat.dtype.name,
+        sqlite3.Binary(confmat.tobytes()),
+        index,
+        json.dumps(policy) if policy is not None else None,
+    )
+
+
+def decode_confmat(numclass, dtype, confmat, index=None):
+    """Decodes the confusion matrix of a row of the `epochs` table into a
+    `(numclass, numclass)` array or, if stored sparse, its sparse encoding."""
+    values = np.frombuffer(confmat, dtype=dtype)
+    if index is None:
+        return values.reshape(numclass, numclass)
+
+    return {
+        "numclass": numclass,
+        "index": np.frombuffer(index, dtype=get_index_dtype(numclass)).tolist(),
+        "value": values.tolist(),
+    }
+
+
+def get_index_dtype(numclass):
+    return np.uint32 if numclass**2 <= 2**32 else np.uint64
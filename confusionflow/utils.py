@@ -2,6 +2,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import binascii
+import contextlib
+import errno
+import json
 import os
 
 
@@ -25,3 +29,48 @@ def get_logdir_from_env():
         )
     else:
         return logdir
+
+
+def write_json_atomic(filepath, data):
+    """Writes `data` to a temporary file which then replaces `filepath`, so
+    readers never see a partially written file."""
+    with open_atomic(filepath, "w") as f:
+        f.write(json.dumps(data))
+
+
+@contextlib.contextmanager
+def open_atomic(filepath, mode="w"):
+    """Opens a temporary file in the folder of `filepath` that replaces
+    `filepath` once it has been written completely.
+
+    The file gets the permissions of a file created with `open`, i.e. the
+    umask is applied to them. The temporary file is removed if writing fails.
+    """
+    fd, tmppath = create_tempfile(filepath)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        getattr(os, "replace", os.rename)(tmppath, filepath)
+    except Exception:
+        if os.path.isfile(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def create_tempfile(filepath, attempts=100):
+    """Creates a new file with a random name next to `filepath` like `open`
+    does, and returns its file descriptor and path."""
+    folder, filename = os.path.split(filepath)
+    flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+    for _ in range(attempts):
+        suffix = binascii.hexlify(os.urandom(6)).decode("ascii")
+        tmppath = os.path.join(folder, ".{}.{}.tmp".format(filename, suffix))
+        try:
+            return os.open(tmppath, flags, 0o666), tmppath
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    raise OSError(errno.EEXIST, "no unused temporary file name", filepath)
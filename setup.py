@@ -34,7 +34,7 @@ pkg_info = {}
 here = os.path.abspath(os.path.dirname(__file__))
 exec(open(os.path.join(here, "confusionflow", "_version.py")).read(), pkg_info)
 
-requirements = {"install": [["flask", "gevent", "pyyaml"]]}
+requirements = {"install": [["flask", "gevent", "numpy", "pyyaml"]]}
 install_requires = requirements["install"]
 
 setup_kwargs = dict(
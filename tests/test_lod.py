@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from confusionflow.confmat import build_pyramid, build_sparse_pyramid, to_coo
+from confusionflow.server.lod import Pyramid
+from confusionflow.server.reader import FoldLogDataReader
+
+NUMCLASS = 5
+
+
+def random_confmats(numepochs, seed=0):
+    rng = np.random.RandomState(seed)
+    confmats = rng.randint(0, 50, size=(numepochs, NUMCLASS, NUMCLASS))
+    return confmats * (rng.rand(*confmats.shape) < 0.2)
+
+
+def test_chunked_pyramid_matches_whole_array():
+    confmats = random_confmats(37)
+    chunks = [confmats[slice(start, start + 8)] for start in range(0, 37, 8)]
+    for (sums, counts), (chunked, chunkcounts) in zip(
+        build_pyramid(confmats), build_pyramid(chunks)
+    ):
+        np.testing.assert_array_equal(chunked, sums)
+        np.testing.assert_array_equal(chunkcounts, counts)
+
+
+def test_sparse_pyramid_matches_dense(tmp_path):
+    confmats = random_confmats(37)
+    epochdata = [
+        {
+            "epochId": epochId,
+            "confmat_sparse": {
+                "numclass": NUMCLASS,
+                "index": np.flatnonzero(confmat).tolist(),
+                "value": confmat.ravel()[np.flatnonzero(confmat)].tolist(),
+            },
+        }
+        for epochId, confmat in enumerate(confmats)
+    ]
+    reader = FoldLogDataReader.from_epochdata("f", epochdata, "f_data.json")
+    pyramid = Pyramid.from_reader(reader)
+    assert pyramid.sparse
+
+    levels = build_pyramid(confmats)
+    assert len(pyramid.levels) == len(levels)
+    for level, (sums, counts) in enumerate(levels, 1):
+        index = np.arange(0, len(counts), 2)
+        np.testing.assert_allclose(
+            pyramid.means(level, index), sums[index] / counts[index].reshape(-1, 1, 1)
+        )
+
+    filepath = str(tmp_path / "f_lod.npz")
+    pyramid.save(filepath)
+    loaded = Pyramid.load(filepath)
+    index = np.arange(len(levels[0][1]))
+    np.testing.assert_array_equal(loaded.means(1, index), pyramid.means(1, index))
+
+
+def test_sparse_pyramid_of_single_epoch_is_empty():
+    epochs, cells, values = to_coo([{"epochId": 1, "confmat": [1, 0, 0, 2]}])
+    assert build_sparse_pyramid(epochs, cells, values, 1, 2) == []
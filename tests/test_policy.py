@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from confusionflow.logging.policy import StratifiedReservoir
+
+
+def draw_sample(quotas, labels, seed, batch_size=64):
+    reservoir = StratifiedReservoir(quotas, seed)
+    for start in range(0, len(labels), batch_size):
+        batch = slice(start, start + batch_size)
+        reservoir.add(np.arange(len(labels))[batch], labels[batch], labels[batch])
+    return np.concatenate([x for x, _ in reservoir.batches()])
+
+
+def test_fills_quotas_without_duplicates():
+    labels = np.repeat([0, 1, 2], [300, 100, 2])
+    sample = draw_sample([30, 10, 5], labels, seed=0)
+    assert len(set(sample.tolist())) == len(sample)
+    np.testing.assert_array_equal(np.bincount(labels[sample]), [30, 10, 2])
+
+
+def test_samples_ordered_batches_uniformly():
+    labels = np.repeat([0, 1], 1000)
+    counts = np.zeros(len(labels))
+    for seed in range(200):
+        counts[draw_sample([50, 50], labels, seed)] += 1
+
+    # every instance is sampled with probability 1/20, not only the first ones
+    assert abs(counts[:100].mean() - 10) < 2
+    assert abs(counts[slice(900, 1000)].mean() - 10) < 2
+
+
+def test_same_seed_draws_same_sample():
+    labels = np.tile([0, 1, 2], 200)
+    np.testing.assert_array_equal(
+        draw_sample([10, 10, 10], labels, seed=1),
+        draw_sample([10, 10, 10], labels, seed=1),
+    )
+
+
+def test_samples_multi_input_batches():
+    labels = np.repeat([0, 1], 100)
+    inputs = {"image": np.arange(200), "meta": -np.arange(200)}
+    reservoir = StratifiedReservoir([10, 10], seed=0)
+    for start in range(0, 200, 64):
+        batch = slice(start, start + 64)
+        x = dict((name, a[batch]) for name, a in inputs.items())
+        reservoir.add(x, labels[batch], labels[batch])
+
+    batches = list(reservoir.batches())
+    images = np.concatenate([x["image"] for x, _ in batches])
+    np.testing.assert_array_equal(
+        np.concatenate([x["meta"] for x, _ in batches]), -images
+    )
+    np.testing.assert_array_equal(np.bincount(labels[images]), [10, 10])
@@ -0,0 +1,98 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+from confusionflow.logging import Fold, Run
+from confusionflow.logging import foldlogdata
+from confusionflow.server import create_app
+from confusionflow.sqlitestore import SQLiteStore, open_store
+
+NUMCLASS = 10
+DATASET_CONFIG = os.path.join(
+    os.path.dirname(__file__), "..", "examples", "dataset-templates", "mnist.yml"
+)
+
+
+def make_confmats(numepochs):
+    confmats = np.zeros((numepochs, NUMCLASS * NUMCLASS), dtype=np.int64)
+    for epoch, confmat in enumerate(confmats):
+        confmat[:: NUMCLASS + 1] = epoch + 5
+        confmat[1] = epoch
+    return confmats
+
+
+@pytest.fixture
+def logdir(tmp_path, monkeypatch):
+    # store the train fold sparse, matrices of 10 classes are dense by default
+    monkeypatch.setattr(foldlogdata, "SPARSE_MIN_NUMCLASS", 2)
+    folds = [
+        Fold(None, "mnist_train", DATASET_CONFIG),
+        Fold(None, "mnist_test", DATASET_CONFIG),
+    ]
+    run = Run("run", folds, "mnist_train")
+    run.foldlogs[0].foldlogdata.sparse_threshold = 0.5
+    for epochId, confmat in enumerate(make_confmats(3)):
+        for foldlog in run.foldlogs:
+            foldlog.add_epochdata(epochId, confmat.tolist())
+
+    path = str(tmp_path / "logs.db")
+    run.export(path)
+    return path
+
+
+def test_export_and_serve(logdir):
+    # the api only, the web frontend is not built in the source tree
+    client = create_app(logdir, config={"ENV": "development"}).test_client()
+    confmats = make_confmats(3)
+
+    runs = json.loads(client.get("/api/runs").data)
+    assert [run["runId"] for run in runs] == ["run"]
+    foldlog = json.loads(client.get("/api/foldlog/run_mnist_test").data)
+    assert foldlog["numepochs"] == 3
+
+    for foldlogId in ["run_mnist_train", "run_mnist_test"]:
+        url = "/api/foldlog/{}/data".format(foldlogId)
+        data = json.loads(client.get(url + "?encoding=dense").data)
+        assert [entry["epochId"] for entry in data["epochdata"]] == [0, 1, 2]
+        assert [entry["confmat"] for entry in data["epochdata"]] == confmats.tolist()
+
+        metrics = json.loads(
+            client.get("/api/foldlog/{}/metrics".format(foldlogId)).data
+        )
+        expected = np.diagonal(
+            confmats.reshape(3, NUMCLASS, NUMCLASS), axis1=1, axis2=2
+        )
+        expected = expected.sum(axis=1) / confmats.sum(axis=1)
+        np.testing.assert_allclose(metrics["accuracy"], expected)
+
+    data = json.loads(client.get("/api/foldlog/run_mnist_train/data").data)
+    assert all("confmat_sparse" in entry for entry in data["epochdata"])
+
+
+def test_sparse_rows_are_stored_sparse(logdir):
+    store = SQLiteStore(logdir, readonly=True)
+    rows = store.connection.execute(
+        "SELECT foldlogId, confmat_index IS NOT NULL FROM epochs"
+    ).fetchall()
+    assert sorted(set(rows)) == [("run_mnist_test", 0), ("run_mnist_train", 1)]
+    store.close()
+
+
+def test_readonly_store_before_schema_exists(tmp_path):
+    path = str(tmp_path / "empty.db")
+    open(path, "w").close()
+
+    store = SQLiteStore(path, readonly=True)
+    assert json.loads(store.get_runs()) == []
+    # the connection serving the empty tables is kept
+    assert store.connection is store.connection
+
+    open_store(path).put_run({"runId": "run", "foldlogs": []})
+    assert [run["runId"] for run in json.loads(store.get_runs())] == ["run"]
+    store.close()
@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import numpy as np
+
+from confusionflow.confmat import compute_accuracy, compute_metrics, sparsify
+from confusionflow.confmat import summarize
+from confusionflow.logging.foldlog import FoldLog
+
+NUMCLASS = 6
+
+
+def random_confmats(numepochs, seed=0):
+    rng = np.random.RandomState(seed)
+    confmats = rng.randint(0, 20, size=(numepochs, NUMCLASS * NUMCLASS))
+    return confmats * (rng.rand(*confmats.shape) < 0.3)
+
+
+def test_sparse_and_dense_entries_give_same_summary():
+    confmats = random_confmats(4)
+    dense = [{"epochId": i, "confmat": m.tolist()} for i, m in enumerate(confmats)]
+    sparse = [
+        {"epochId": i, "confmat_sparse": sparsify(m)} for i, m in enumerate(confmats)
+    ]
+
+    expected = compute_metrics(confmats.reshape(-1, NUMCLASS, NUMCLASS))
+    np.testing.assert_allclose(compute_accuracy(dense), expected["accuracy"])
+    np.testing.assert_allclose(compute_accuracy(sparse), expected["accuracy"])
+
+    accuracy = compute_accuracy(dense)
+    summary = summarize(range(4), accuracy, sparse[-1])
+    assert summary == summarize(range(4), accuracy, dense[-1])
+    assert summary["final"]["accuracy"] == round(expected["accuracy"][-1], 4)
+    counts = [confusion["count"] for confusion in summary["topconfusions"]]
+    assert counts == sorted(counts, reverse=True)
+    assert all(c["actual"] != c["predicted"] for c in summary["topconfusions"])
+
+
+def test_summary_does_not_grow_with_epochs():
+    foldlog = FoldLog("run_fold", "run", "fold")
+    sizes = []
+    for epochId, confmat in enumerate(random_confmats(500)):
+        foldlog.add_epochdata(epochId, confmat.tolist())
+        sizes.append(len(json.dumps(foldlog.asdict())))
+
+    assert set(foldlog.asdict()["summary"]) == {"final", "best", "topconfusions"}
+    # per-epoch lists of 500 accuracies and epochIds would take several KB
+    assert max(sizes) < 1000
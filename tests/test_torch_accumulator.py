@@ -0,0 +1,81 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import pytest
+
+from confusionflow.logging import ConfusionAccumulator, Fold, Run
+from confusionflow.logging import TorchConfusionAccumulator
+
+torch = pytest.importorskip("torch")
+
+NUMCLASS = 4
+DATASET_CONFIG = os.path.join(
+    os.path.dirname(__file__), "..", "examples", "dataset-templates", "mnist.yml"
+)
+
+
+def test_matches_numpy_accumulator():
+    rng = np.random.RandomState(0)
+    accumulator = ConfusionAccumulator(NUMCLASS)
+    torch_accumulator = TorchConfusionAccumulator(NUMCLASS, "cpu")
+
+    for size in [7, 0, 32]:
+        targets = rng.randint(NUMCLASS, size=size)
+        predictions = rng.randint(NUMCLASS, size=size)
+        accumulator.update(targets, predictions)
+        torch_accumulator.update(
+            torch.from_numpy(targets), torch.from_numpy(predictions)
+        )
+
+    np.testing.assert_array_equal(torch_accumulator.value(), accumulator.value())
+    assert torch_accumulator.tolist() == accumulator.tolist()
+
+    torch_accumulator.reset()
+    assert not torch_accumulator.value().any()
+
+
+@pytest.mark.parametrize("label", [-1, NUMCLASS])
+def test_rejects_labels_out_of_range(label):
+    for targets, predictions in [([0, label], [0, 1]), ([0, 1], [label, 1])]:
+        torch_accumulator = TorchConfusionAccumulator(NUMCLASS)
+        # labels are only checked when the counts are copied to the host
+        torch_accumulator.update(torch.tensor(targets), torch.tensor(predictions))
+        with pytest.raises(ValueError):
+            torch_accumulator.value()
+        with pytest.raises(ValueError):
+            torch_accumulator.tolist()
+
+        torch_accumulator.reset()
+        assert not torch_accumulator.value().any()
+
+
+def test_log_epoch():
+    from confusionflow.logging.logfunction import log_epoch
+
+    torch.manual_seed(0)
+    inputs = torch.randn(50, 3)
+    targets = torch.randint(NUMCLASS, (50,))
+    dataset = torch.utils.data.TensorDataset(inputs, targets)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=16)
+    model = torch.nn.Linear(3, NUMCLASS)
+
+    folds = [
+        Fold(loader, "mnist_train", DATASET_CONFIG),
+        Fold(loader, "mnist_test", DATASET_CONFIG),
+    ]
+    run = Run("run", folds, "mnist_train")
+    log_epoch(run, model, "cpu", 1, numclass=NUMCLASS)
+
+    with torch.no_grad():
+        predictions = model(inputs).argmax(dim=1)
+    expected = ConfusionAccumulator(NUMCLASS)
+    expected.update(targets.numpy(), predictions.numpy())
+
+    for foldlog in run.foldlogs:
+        epochdata = foldlog.foldlogdata.epochdata
+        assert [entry["epochId"] for entry in epochdata] == [1]
+        assert epochdata[0]["confmat"] == expected.tolist()